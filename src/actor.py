@@ -1,88 +1,214 @@
 """
 Class to represent an Actor, its information, decision-making process, and behaviour.
+The actors of a simulation run are kept column-wise in an ActorStore;
+an Actor is only a thin view onto one of its rows.
 """
 
 from abc import ABC
+from array import array
 from typing import List, Tuple
 from atis import Atis
-from collections import defaultdict
+from utils import softmax_travel_times
+
+import numpy as np
 
 
 class AbstractActor(ABC):
 
+    __slots__ = ()
+
     static_model_id = 1
 
-    def __init__(self):
-        """"Initializer for the ID of all actor models"""
-        self.actor_id = AbstractActor.static_model_id
+    @staticmethod
+    def new_id() -> int:
+        """Get a new ID, unique across all actor models"""
+        actor_id = AbstractActor.static_model_id
         AbstractActor.static_model_id += 1
+        return actor_id
+
+
+class ActorStore:
+    """
+    Struct-of-arrays storage of the actors of a simulation run.
+    Each column is a compact typed array, which can be read as a whole
+    as a numpy array through get_column.
+    """
+
+    COLUMNS = {
+        'actor_id': 'q',
+        'route_id': 'q',
+        'uses_atis': 'b',
+        'start_time': 'd',
+        'current_node': 'q',
+        'dest_node': 'q',
+        # number of edges already traveled
+        'hops': 'q',
+        # sum of the travel time of the edges started so far
+        'edges_travel_time': 'd',
+        'total_travel_time': 'd'
+    }
+
+    routes: List[List[int]]
+    atis: Atis
+
+    def __init__(self, keep_trails: bool = False):
+        """If keep_trails is set, the (time, node) history of every actor is kept for printing"""
+        for name, typecode in self.COLUMNS.items():
+            setattr(self, name, array(typecode))
+        self.routes = []
+        self.route_ids = {}
+        self.atis = None
+        self.trails = [] if keep_trails else None
+
+    def __len__(self) -> int:
+        return len(self.actor_id)
+
+    def __getitem__(self, idx: int):
+        return Actor(self, idx)
+
+    def __iter__(self):
+        return (Actor(self, idx) for idx in range(len(self)))
+
+    def get_route_id(self, route: List[int]) -> int:
+        """Get the id of a route in the routes table, adding it if needed"""
+        key = tuple(route)
+        route_id = self.route_ids.get(key)
+        if route_id is None:
+            route_id = self.route_ids[key] = len(self.routes)
+            self.routes.append(route)
+        return route_id
+
+    def add(self, route: List[int], atis: Atis):
+        """Add a new actor that will travel from the start to the end of the route.
+        If atis is given, the actor will follow its recommendations"""
+        if atis is not None:
+            self.atis = atis
+
+        self.actor_id.append(AbstractActor.new_id())
+        self.route_id.append(self.get_route_id(route))
+        self.uses_atis.append(atis is not None)
+        self.start_time.append(0.0)
+        self.current_node.append(route[0])
+        self.dest_node.append(route[-1])
+        self.hops.append(0)
+        self.edges_travel_time.append(0.0)
+        self.total_travel_time.append(0.0)
+        if self.trails is not None:
+            self.trails.append([])
+        return Actor(self, len(self) - 1)
+
+    def get_column(self, name: str) -> np.ndarray:
+        """Get a copy of the given column"""
+        return np.array(getattr(self, name))
+
+    def reached_dest(self) -> np.ndarray:
+        """Mask of the actors that reached their destination"""
+        return self.get_column('current_node') == self.get_column('dest_node')
+
+    def finish(self, max_run_time: float):
+        """Set the total travel time of all the actors that did not reach their destination"""
+        for idx in np.flatnonzero(~self.reached_dest()):
+            self.total_travel_time[idx] = max_run_time
 
 
 class Actor(AbstractActor):
+    """View of an actor stored in an ActorStore"""
+
+    __slots__ = ('store', 'idx')
 
     TIME_INDEX = 0
     NODE_INDEX = 1
 
-    base_route: List[int]
-    atis: Atis
-    # Tuple[time actor arrived to node, node]
-    traveled_nodes: List[Tuple[float, int]]
-
-    route_travel_time: defaultdict
-    total_travel_time: float
+    store: ActorStore
+    idx: int
 
-    def __init__(self, route: List[int], atis: Atis):
-        super().__init__()
-        self.base_route = route
-        self.atis = atis
-        self.route_travel_time = defaultdict(lambda: 0.0)
-        self.total_travel_time = 0.0
-        self.start_time = 0.0
+    def __init__(self, store: ActorStore, idx: int):
+        self.store = store
+        self.idx = idx
 
     def __repr__(self):
         return "A%d :: TI %.4f :: TTT %.4f" % (self.actor_id, round(self.start_time, 4), round(self.total_travel_time, 4))
 
+    @property
+    def actor_id(self) -> int:
+        return self.store.actor_id[self.idx]
+
+    @property
+    def base_route(self) -> List[int]:
+        return self.store.routes[self.store.route_id[self.idx]]
+
+    @property
+    def atis(self) -> Atis:
+        return self.store.atis if self.store.uses_atis[self.idx] else None
+
+    @property
+    def start_time(self) -> float:
+        return self.store.start_time[self.idx]
+
+    @property
+    def total_travel_time(self) -> float:
+        return self.store.total_travel_time[self.idx]
+
+    @total_travel_time.setter
+    def total_travel_time(self, value: float):
+        self.store.total_travel_time[self.idx] = value
+
+    @property
+    def traveled_nodes(self) -> List[Tuple[float, int]]:
+        """Tuple[time actor arrived to node, node], only available if the store keeps trails"""
+        return self.store.trails[self.idx]
+
     def uses_atis(self) -> bool:
         """Check if this actor uses Atis"""
-        return self.atis is not None
+        return bool(self.store.uses_atis[self.idx])
 
     def add_time_for_edge(self, edge: Tuple[int, int], tt: float):
-        self.route_travel_time[edge] = tt
+        self.store.edges_travel_time[self.idx] += tt
 
     def update_total_tt(self):
-        self.total_travel_time = sum(self.route_travel_time.values())
+        self.store.total_travel_time[self.idx] = self.store.edges_travel_time[self.idx]
 
     def reached_dest(self) -> bool:
         """Check whether this actor reached its destination"""
-        return self.base_route[-1] == self.traveled_nodes[-1][self.NODE_INDEX]
+        return self.store.current_node[self.idx] == self.store.dest_node[self.idx]
 
     def get_next_travel_edge(self, timestamp: float) -> Tuple[int, int]:
         """Gets the next edge to be traveled"""
-        if not self.uses_atis():
-            return (self.traveled_nodes[-1][self.NODE_INDEX],
-                    self.base_route[len(self.traveled_nodes)])
+        store, idx = self.store, self.idx
+        if not store.uses_atis[idx]:
+            return (store.current_node[idx],
+                    store.routes[store.route_id[idx]][store.hops[idx] + 1])
         else:
-            return self.atis.get_edge_prediction(
-                self.traveled_nodes[-1][self.NODE_INDEX],
-                self.base_route[-1],
+            return store.atis.get_edge_prediction(
+                store.current_node[idx],
+                store.dest_node[idx],
                 timestamp
             )
 
     def start_trip(self, at_time: float):
         """Make the actor start the route, at the given time"""
-        self.start_time = at_time
-        self.traveled_nodes = [(at_time, self.base_route[0])]   # Start node
+        self.store.start_time[self.idx] = at_time
+        if self.store.trails is not None:
+            self.store.trails[self.idx].append((at_time, self.store.current_node[self.idx]))
 
     def travel(self, at_time: float, edge: Tuple[int, int]):
         """Makes the Actor travel the given edge"""
-        if not self.traveled_nodes[-1][self.NODE_INDEX] == edge[0]:
+        store, idx = self.store, self.idx
+        if not store.current_node[idx] == edge[0]:
             raise Exception
 
-        self.traveled_nodes.append((at_time, edge[1]))
+        store.current_node[idx] = edge[1]
+        store.hops[idx] += 1
+        if store.trails is not None:
+            store.trails[idx].append((at_time, edge[1]))
 
     def print_traveled_route(self):
         """Pretty printing of the Actor's traveled route"""
         print("Actor #%d:" % self.actor_id)
+        if self.store.trails is None:
+            print("\tTraveled route not kept")
+            return
+
         print("\tNode: %d, timestamp: %f" %
               (self.traveled_nodes[0][self.NODE_INDEX],
                self.traveled_nodes[0][self.TIME_INDEX]))
@@ -93,3 +219,40 @@ class Actor(AbstractActor):
                    self.traveled_nodes[i][self.TIME_INDEX],
                    self.traveled_nodes[i][self.TIME_INDEX]
                    - self.traveled_nodes[i-1][self.TIME_INDEX]))
+
+
+class ActorFactory:
+    """
+    Creates the actors of a run. The route of each actor, chosen with a probability
+    based on how little time it takes to transverse it, and whether it uses atis
+    are drawn for all the actors at once, when the run is prepared.
+    """
+
+    def __init__(self, use_atis_p: float):
+        self.use_atis_p = use_atis_p
+        self.routes = []
+        self.route_choices = np.empty(0, dtype=int)
+        self.atis_choices = np.empty(0, dtype=bool)
+        self.next = 0
+
+    def prepare(self, graph, num_actors: int):
+        """Draw the routes and atis usage of the given number of actors"""
+        self.routes = graph.get_all_routes()
+        routes_times = [graph.get_optimal_route_travel_time(r) for r in self.routes]
+        cum_probs = np.cumsum(softmax_travel_times(routes_times))
+
+        u = np.random.random((num_actors, 2))
+        self.route_choices = np.minimum(np.searchsorted(cum_probs, u[:, 0], side='right'),
+                                        len(self.routes) - 1)
+        self.atis_choices = u[:, 1] < self.use_atis_p
+        self.next = 0
+
+    def __call__(self, graph, atis: Atis, store: ActorStore) -> Actor:
+        """Add the next of the drawn actors to the store"""
+        if self.next >= len(self.route_choices):
+            # more actors than prepared for, draw another batch
+            self.prepare(graph, max(1, len(self.route_choices)))
+        idx = self.next
+        self.next += 1
+        return store.add(self.routes[self.route_choices[idx]],
+                         atis if self.atis_choices[idx] else None)
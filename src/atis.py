@@ -2,11 +2,11 @@
 Class resembling an ATIS - Advanced Traveler Information Systems.
 Has knwoledge about the roadgraph characteristcs
 """
-from typing import List, Tuple
-from queue import PriorityQueue
+from typing import Iterable, Iterator, List, Tuple
 from graph import RoadGraph
 from abc import ABC, abstractmethod
-from utils import MultimodalDistribution
+from utils import MultimodalDistribution, DemandTable
+from routing import RoutingEngine, ExhaustiveRouting
 
 
 class Atis(ABC):
@@ -14,37 +14,87 @@ class Atis(ABC):
 
     graph: RoadGraph
     percentage_usage: int
+    routing: RoutingEngine
 
-    def __init__(self, graph: RoadGraph, p_usage: float):
+    # whether an edge is never predicted to be faster than its free flow travel time
+    FREE_FLOW_BOUND = True
+    # whether the cost of an edge depends on the time it is reached at
+    TIME_DEPENDENT = False
+
+    def __init__(self, graph: RoadGraph, p_usage: float, routing: RoutingEngine = None):
         self.percentage_usage = p_usage
         self.graph = graph
+        self.routing = routing if routing is not None else ExhaustiveRouting()
+        # best next edge per (src, dst, time bucket), valid while the state version is unchanged
+        self.decisions = {}
+        self.decisions_version = None
+        self.decision_hits = 0
+        self.decision_misses = 0
+        # decisions at nodes with a single successor, which never look the memo up
+        self.decision_forced = 0
 
     @abstractmethod
     def get_edge_predicted_tt(self, edge: (int, int), timestamp: float):
         """Get the estimated travel time for a given edge."""
         pass
 
+    def get_edge_cost(self, edge: (int, int), at_time: float, _: float):
+        """Get the estimated travel time for an edge reached at 'at_time',
+        for a route decided at the given timestamp"""
+        return self.get_edge_predicted_tt(edge, at_time)
+
     def get_predicted_tt_from_edges(self, edges: List[Tuple[int, int]], _: float):
         """Get the estimated travel time for a given set of sequential edges"""
         return sum([self.get_edge_predicted_tt(e, _) for e in edges])
 
+    def iter_edge_costs(self, edges: Iterable[Tuple[int, int]], timestamp: float) -> Iterator[float]:
+        """Get the estimated travel times of a set of sequential edges, one at a time,
+        as summed by get_predicted_tt_from_edges"""
+        for e in edges:
+            yield self.get_edge_predicted_tt(e, timestamp)
+
     def get_predicted_tt_from_nodes(self, route: List[int], timestamp: float):
         """Get the travel time associated to a set of sequential nodes - a route"""
         edges = list(zip(
             route, route[1:]))     # [(r[i],r[i+1]) for i in range(len(r)-1)] <- for bigger lists
         return self.get_predicted_tt_from_edges(edges, timestamp)
 
-    def get_edge_prediction(self, src_node: int, dest_node: int, timestamp: float):
-        """Get the fastest edge that takes the actor from the node 'src_node'
-        to the node 'dest_node'"""
-        routes = [route for route
-                  in self.graph.get_possible_routes(src_node, dest_node)]
+    def get_state_version(self) -> int:
+        """Version of the graph state the predictions depend on"""
+        return self.graph.state_version
 
-        tts = [self.get_predicted_tt_from_nodes(route, timestamp)
-               for route in routes]
-        idx = tts.index(min(tts))
+    def get_time_bucket(self, timestamp: float):
+        """Decisions taken at timestamps of the same bucket, under the same state, are the same"""
+        return timestamp
 
-        return tuple(routes[idx][:2])
+    def get_edge_prediction(self, src_node: int, dest_node: int, timestamp: float):
+        """Get the fastest edge that takes the actor from the node 'src_node'
+        to the node 'dest_node'. Decisions are reused until the state they depend on changes"""
+        successors = self.graph.get_successors(src_node)
+        if len(successors) == 1:
+            # forced decision, whatever the state
+            self.decision_forced += 1
+            return (src_node, successors[0])
+
+        version = self.get_state_version()
+        if version != self.decisions_version:
+            self.decisions.clear()
+            self.decisions_version = version
+
+        key = (src_node, dest_node, self.get_time_bucket(timestamp))
+        edge = self.decisions.get(key)
+        if edge is not None:
+            self.decision_hits += 1
+            return edge
+
+        self.decision_misses += 1
+        edge = self.decisions[key] = self.routing.get_edge_prediction(self, src_node, dest_node, timestamp)
+        return edge
+
+    def decision_hit_rate(self) -> float:
+        """Share of the memo lookups that found the decision, forced decisions aside"""
+        decisions = self.decision_hits + self.decision_misses
+        return self.decision_hits / decisions if decisions > 0 else 0.0
 
 
 class CurrentAtis(Atis):
@@ -53,6 +103,9 @@ class CurrentAtis(Atis):
     def get_edge_predicted_tt(self, edge: (int, int), _: float):
         return self.graph.get_edge_real_travel_time(edge)
 
+    def get_time_bucket(self, timestamp: float):
+        return None
+
 
 class PrevisionAtis(Atis):
     """
@@ -64,26 +117,73 @@ class PrevisionAtis(Atis):
 
     traffic_dist: MultimodalDistribution
     num_actors: int
-
-    def __init__(self, graph: RoadGraph, p_usage: float, td: MultimodalDistribution, num_actors: int):
-        super().__init__(graph, p_usage)
+    demand: DemandTable
+
+    # the real to predicted ratio may scale an edge below its free flow travel time
+    FREE_FLOW_BOUND = False
+    TIME_DEPENDENT = True
+
+    def __init__(self, graph: RoadGraph, p_usage: float, td: MultimodalDistribution, num_actors: int,
+                 routing: RoutingEngine = None, resolution: float = 0.0, horizon: float = 48.0):
+        """
+        With a positive resolution (in hours), the demand is tabulated at the start of every
+        time bucket over the horizon, and the predicted travel time of each edge is cached per
+        bucket, linearly interpolated within it. Otherwise predictions are exact.
+        """
+        super().__init__(graph, p_usage, routing)
         self.traffic_dist = td
         self.num_actors = num_actors
+        self.resolution = resolution
+        self.demand = DemandTable(td, num_actors, horizon, resolution)
+        # (edge, bucket) -> (bucket start, predicted travel time at the start, its slope)
+        self.costs = {}
+        self.costs_version = graph.capacity_version
 
     def get_edge_predicted_tt(self, edge: (int, int), timestamp: float):
-        return self.graph.get_edge_travel_time(edge, self.traffic_dist.pdf(timestamp) * self.num_actors)
+        if self.resolution <= 0:
+            return self.graph.get_edge_travel_time(edge, self.demand.exact(timestamp))
+
+        # cached costs are only valid for the capacities they were computed with
+        if self.costs_version != self.graph.capacity_version:
+            self.costs.clear()
+            self.costs_version = self.graph.capacity_version
+
+        bucket = int(timestamp // self.resolution)
+        entry = self.costs.get((edge, bucket))
+        if entry is None:
+            start = bucket * self.resolution
+            cost = self.graph.get_edge_travel_time(edge, self.demand.at_bucket(bucket))
+            end_cost = self.graph.get_edge_travel_time(edge, self.demand.at_bucket(bucket + 1))
+            entry = self.costs[(edge, bucket)] = (start, cost, (end_cost - cost) / self.resolution)
+
+        start, cost, slope = entry
+        return cost + slope * (timestamp - start)
+
+    def get_time_bucket(self, timestamp: float):
+        # predictions are exact unless a resolution is set
+        return int(timestamp // self.resolution) if self.resolution > 0 else timestamp
+
+    def get_edge_cost(self, edge: (int, int), at_time: float, ts: float):
+        # ratio = edge real travel time \
+        #   edge expected travel time according to traffic distribution
+        # ts = predicted timestamp * ratio
+        return self.get_edge_predicted_tt(edge, at_time) *\
+            (self.graph.get_edge_real_travel_time(edge)
+             / self.get_edge_predicted_tt(edge, ts))
+
+    def iter_edge_costs(self, edges: Iterable[Tuple[int, int]], ts: float) -> Iterator[float]:
+        timestamp = ts
+        for e in edges:
+            travel_time = self.get_edge_cost(e, timestamp, ts)
+            yield travel_time
+            timestamp += travel_time
 
     def get_predicted_tt_from_edges(self, edges: List[Tuple[int, int]], ts: float):
         timestamp = ts
         estimates = []
 
         for e in edges:
-            # ratio = edge real travel time \
-            #   edge expected travel time according to traffic distribution
-            # ts = predicted timestamp * ratio
-            travel_time = self.get_edge_predicted_tt(e, timestamp) *\
-                (self.graph.get_edge_real_travel_time(e)
-                 / self.get_edge_predicted_tt(e, ts))
+            travel_time = self.get_edge_cost(e, timestamp, ts)
 
             estimates.append(travel_time)
             timestamp += travel_time
@@ -103,18 +203,13 @@ class AdherenceAtis(Atis):
     This is the one we're using in the paper as "CurrentAtis".
     """
 
-    def __init__(self, graph: RoadGraph, p_usage: float, event_queue: PriorityQueue):
-        super().__init__(graph, p_usage)
-        self.event_queue = event_queue
-
     def get_edge_predicted_tt(self, edge: (int, int), _: float):
-        from event import EdgeEndEvent  # This is here because of circular dependencies
+        edge_atis_users = self.graph.get_edge_atis_volume(edge)
+        return self.graph.get_edge_travel_time(edge, edge_atis_users / self.percentage_usage)
 
-        edge_atis_users = sum(
-            [1 for _, ev in self.event_queue.queue
-             if isinstance(ev, EdgeEndEvent) and
-                ev.actor.uses_atis() and
-                ev.edge == edge]
-        )
+    def get_state_version(self) -> int:
+        # only the atis users are seen
+        return self.graph.atis_state_version
 
-        return self.graph.get_edge_travel_time(edge, edge_atis_users / self.percentage_usage)
+    def get_time_bucket(self, timestamp: float):
+        return None
@@ -0,0 +1,465 @@
+"""
+Lockstep simulation of several replications of the same configuration.
+Replications only differ in their random draws, which all happen before their
+first event, so they can be advanced together: every step processes the next
+event of each replication, and the edges state and statistics of all of them
+are kept as (replications x edges) arrays, so that the edges travel times and
+the ATIS route costs are computed for all the replications at once.
+
+Each replication has the same results as when simulated on its own with
+online statistics (see statistics.OnlineSimStats) and exhaustive routing.
+"""
+from heapq import heappush, heappop
+from typing import List
+
+from atis import Atis, CurrentAtis, AdherenceAtis, PrevisionAtis
+from graph import RoadGraph
+from routing import ExhaustiveRouting
+from statistics import RunSummary, RunningStats
+from utils import MultimodalDistribution, congestion_time_estimates, replication_seed
+
+import random
+import numpy as np
+
+
+class BatchSimulator:
+    """
+    Runs the given replications of a configuration in lockstep.
+    Memory grows with replications x edges, and with replications x actors.
+    """
+
+    # kinds of the events in the replications queues
+    START = 0
+    END = 1
+    ACCIDENT = 2
+    ARRIVAL = 3
+
+    def __init__(self,
+                 config,
+                 replications: List[int],
+                 actor_constructor,
+                 atis_constructor,
+                 traffic_distribution=MultimodalDistribution.default(),
+                 graph_constructor=RoadGraph,
+                 accidents=None,
+                 seed=42):
+        """Accidents are given as (time, edge, capacity scale factor) tuples"""
+        self.config = config
+        self.replications = list(replications)
+        self.num_actors = config.num_actors
+        self.max_run_time = config.max_run_time
+        self.actor_constructor = actor_constructor
+        self.traffic_distribution = traffic_distribution
+        self.graph_constructor = graph_constructor
+        self.accidents = accidents if accidents is not None else []
+        self.seed = seed
+
+        # the graph the routes are looked up on, its state is not used
+        self.graph = graph_constructor()
+        self.atis = atis_constructor(self.graph, traffic_distribution)
+        if not isinstance(self.atis, Atis):
+            raise ValueError("invalid atis: %s" % (self.atis,))
+        if not isinstance(self.atis.routing, ExhaustiveRouting):
+            raise ValueError("batch runs cost every route, as ExhaustiveRouting, not %s" %
+                             type(self.atis.routing).__name__)
+
+        self.edges = list(self.graph.edge_ids)
+        self.num_edges = len(self.edges)
+        # edge id self.num_edges is a dummy edge that routes are padded with, it costs nothing
+        self.free_flow = np.append(self.graph.free_flow, 0.0)
+        self.edge_dest = np.array([v for _, v in self.edges], dtype=int)
+
+        # routes from each node to the destination, as a (nodes, routes, edges) table of edge ids,
+        # padded with dummy routes that cost an infinite time
+        self.route_rows = {}
+        self.route_table = np.empty((0, 0, 0), dtype=int)
+        self.route_padding = np.empty((0, 0))
+
+    def seed_replication(self, run: int):
+        """Seed the random generators with the stream of the given replication, as Simulator does"""
+        run_seed = replication_seed(self.seed, run)
+        random.seed(run_seed)
+        np.random.seed(run_seed & 0xFFFFFFFF)
+
+    def start(self):
+        """Set up all the replications, drawing their actors"""
+        n_reps, n_actors, n_edges = len(self.replications), self.num_actors, self.num_edges
+
+        arrivals = np.empty((n_reps, n_actors))
+        self.route_choice = np.empty((n_reps, n_actors), dtype=int)
+        self.uses_atis = np.empty((n_reps, n_actors), dtype=bool)
+        for i, run in enumerate(self.replications):
+            # same draws, in the same order, as Simulator.start
+            self.seed_replication(run)
+            arrivals[i] = np.sort(self.traffic_distribution.sample(n_actors))
+            self.actor_constructor.prepare(self.graph, n_actors)
+            self.route_choice[i] = self.actor_constructor.route_choices
+            self.uses_atis[i] = self.actor_constructor.atis_choices
+
+        # base routes as edge ids, padded with the dummy edge
+        routes = self.actor_constructor.routes
+        self.base_routes = np.full((len(routes), max(len(r) for r in routes)), n_edges, dtype=int)
+        for k, r in enumerate(routes):
+            self.base_routes[k, :len(r) - 1] = [self.graph.edge_ids[e] for e in zip(r, r[1:])]
+        self.arrivals = [row.tolist() for row in arrivals]
+        self.arrived = [0] * n_reps
+
+        # actors state
+        self.node = np.full((n_reps, n_actors), self.graph.nstart, dtype=int)
+        self.hops = np.zeros((n_reps, n_actors), dtype=int)
+        self.start_time = np.zeros((n_reps, n_actors))
+        self.edges_travel_time = np.zeros((n_reps, n_actors))
+        self.total_travel_time = np.zeros((n_reps, n_actors))
+
+        # edges state
+        self.volume = np.zeros((n_reps, n_edges + 1), dtype=int)
+        self.atis_volume = np.zeros((n_reps, n_edges + 1), dtype=int)
+        self.capacity = np.tile(np.append(self.graph.capacity, 1.0), (n_reps, 1))
+
+        # statistics, as accumulated by OnlineSimStats
+        self.num_in_graph = np.zeros(n_reps, dtype=int)
+        self.actors_area = np.zeros(n_reps)
+        self.actors_last_ts = np.zeros(n_reps)
+        self.max_actors = np.zeros(n_reps, dtype=int)
+        self.edges_count = np.zeros((n_reps, n_edges + 1), dtype=int)
+        self.edges_area = np.zeros((n_reps, n_edges + 1))
+        self.edges_last_ts = np.zeros((n_reps, n_edges + 1))
+        self.edges_max = np.zeros((n_reps, n_edges + 1), dtype=int)
+        # per class accumulators, atis users first, both brought up to every update
+        self.class_count = np.zeros((n_reps, 2), dtype=int)
+        self.class_area = np.zeros((n_reps, 2))
+        self.class_last_ts = np.zeros((n_reps, 2))
+        self.class_max = np.zeros((n_reps, 2), dtype=int)
+        self.edges_class_count = np.zeros((n_reps, n_edges + 1, 2), dtype=int)
+        self.edges_class_area = np.zeros((n_reps, n_edges + 1, 2))
+        self.edges_class_last_ts = np.zeros((n_reps, n_edges + 1, 2))
+        self.edges_class_max = np.zeros((n_reps, n_edges + 1, 2), dtype=int)
+        # running statistics of the trips travel times, per class
+        self.trip_n = np.zeros((n_reps, 2), dtype=int)
+        self.trip_mean = np.zeros((n_reps, 2))
+        self.trip_m2 = np.zeros((n_reps, 2))
+        self.trip_max = np.full((n_reps, 2), -np.inf)
+        # step at which each edge was first traveled, which orders the edges of the summary
+        self.edges_first_use = np.full((n_reps, n_edges + 1), -1, dtype=int)
+        self.tt_n = np.zeros((n_reps, n_edges + 1), dtype=int)
+        self.tt_mean = np.zeros((n_reps, n_edges + 1))
+        self.tt_m2 = np.zeros((n_reps, n_edges + 1))
+        self.tt_max = np.full((n_reps, n_edges + 1), -np.inf)
+
+        # pending events of each replication, but for the arrivals:
+        # (time, sequence number, kind, actor or accident, edge id)
+        self.queues = [[] for _ in range(n_reps)]
+        self.seq = [0] * n_reps
+        for i in range(n_reps):
+            for j, (at_time, edge, _) in enumerate(self.accidents):
+                self.schedule(i, at_time, self.ACCIDENT, j, self.graph.edge_ids[tuple(edge)])
+        self.active = list(range(n_reps))
+        self.steps = 0
+
+    def schedule(self, rep: int, at_time: float, kind: int, idx: int, edge: int):
+        self.seq[rep] += 1
+        heappush(self.queues[rep], (at_time, self.seq[rep], kind, idx, edge))
+
+    def run(self) -> List[RunSummary]:
+        """Simulate all the replications, returning their summaries in order"""
+        self.start()
+        while self.step():
+            pass
+        return [self.get_summary(i) for i in range(len(self.replications))]
+
+    def next_events(self) -> np.ndarray:
+        """Dequeue the next event of each replication with pending events, arrivals first on ties.
+        Returns a row per event: replication, kind, time, actor or accident, edge id, time of the following event"""
+        inf = float('inf')
+        n_actors = self.num_actors
+        events = []
+        for i in self.active:
+            queue = self.queues[i]
+            k = self.arrived[i]
+            arrival = self.arrivals[i][k] if k < n_actors else inf
+            if queue and queue[0][0] < arrival:
+                at_time, _, kind, idx, edge = heappop(queue)
+            else:
+                at_time, kind, idx, edge = arrival, self.ARRIVAL, k, -1
+                k = self.arrived[i] = k + 1
+                arrival = self.arrivals[i][k] if k < n_actors else inf
+            events.append((i, kind, at_time, idx, edge, min(queue[0][0], arrival) if queue else arrival))
+        return np.array(events).reshape(-1, 6)
+
+    def step(self) -> bool:
+        """Process the next event of every replication. Returns whether there were any"""
+        n_actors = self.num_actors
+        self.active = [i for i in self.active if self.queues[i] or self.arrived[i] < n_actors]
+        if not self.active:
+            return False
+
+        events = self.next_events()
+        reps, kinds, idxs, edges = events[:, [0, 1, 3, 4]].astype(int).T
+        times, following = events[:, 2], events[:, 5]
+
+        for p in np.flatnonzero(kinds == self.ACCIDENT):
+            _, _, factor = self.accidents[idxs[p]]
+            self.capacity[reps[p], edges[p]] *= factor
+
+        # actors that need their next edge: arrivals, and those ending an edge short of the destination
+        arrivals = np.flatnonzero(kinds == self.ARRIVAL)
+        ar, aa = reps[arrivals], idxs[arrivals]
+        self.count_actors(ar, aa, times[arrivals], 1)
+        self.start_time[ar, aa] = times[arrivals]
+
+        ends = np.flatnonzero(kinds == self.END)
+        continuing = ends[self.end_edge(reps[ends], idxs[ends], times[ends], edges[ends])]
+        deciding = np.concatenate((arrivals, continuing))
+        edges[deciding] = self.next_edges(reps[deciding], idxs[deciding], times[deciding])
+
+        # an edge start is handled at once if nothing else is pending until then, as in Simulator.can_fuse
+        fused = (times[deciding] < self.max_run_time) & (following[deciding] > times[deciding])
+        for p in deciding[~fused].tolist():
+            if times[p] < self.max_run_time:
+                self.schedule(reps[p], times[p].item(), self.START, idxs[p], edges[p])
+
+        starting = np.concatenate((np.flatnonzero(kinds == self.START), deciding[fused]))
+        sr, sa, st, se = reps[starting], idxs[starting], times[starting], edges[starting]
+        end_times = self.start_edge(sr, sa, st, se)
+        queues, seq, max_run_time = self.queues, self.seq, self.max_run_time
+        for r, a, e, t in zip(sr.tolist(), sa.tolist(), se.tolist(), end_times.tolist()):
+            if t < max_run_time:
+                seq[r] += 1
+                heappush(queues[r], (t, seq[r], self.END, a, e))
+
+        self.steps += 1
+        return True
+
+    @staticmethod
+    def integrate(count: np.ndarray, area: np.ndarray, last_ts: np.ndarray, maxima: np.ndarray,
+                  index: tuple, ts: np.ndarray, delta):
+        """statistics.integrate, on the given entries of the accumulators arrays"""
+        old_count = count[index]
+        new_count = old_count + delta
+        area[index] += (ts - last_ts[index]) * (old_count + new_count) / 2.0
+        last_ts[index] = ts
+        count[index] = new_count
+        maxima[index] = np.maximum(maxima[index], new_count)
+
+    def count_actors(self, reps: np.ndarray, actors: np.ndarray, ts: np.ndarray, delta: int):
+        """OnlineSimStats.update_num_actors, at most once per replication"""
+        self.integrate(self.num_in_graph, self.actors_area, self.actors_last_ts, self.max_actors,
+                       (reps,), ts, delta)
+        atis = self.uses_atis[reps, actors]
+        for c, class_delta in enumerate([np.where(atis, delta, 0), np.where(atis, 0, delta)]):
+            self.integrate(self.class_count, self.class_area, self.class_last_ts, self.class_max,
+                           (reps, c), ts, class_delta)
+
+    def count_edges(self, reps: np.ndarray, actors: np.ndarray, edges: np.ndarray, ts: np.ndarray, delta: int):
+        """OnlineSimStats.update_num_actors_edge, at most once per replication"""
+        self.integrate(self.edges_count, self.edges_area, self.edges_last_ts, self.edges_max,
+                       (reps, edges), ts, delta)
+        atis = self.uses_atis[reps, actors]
+        for c, class_delta in enumerate([np.where(atis, delta, 0), np.where(atis, 0, delta)]):
+            self.integrate(self.edges_class_count, self.edges_class_area, self.edges_class_last_ts,
+                           self.edges_class_max, (reps, edges, c), ts, class_delta)
+
+    def add_trip_times(self, reps: np.ndarray, actors: np.ndarray):
+        """OnlineSimStats.add_trip_time, at most once per replication"""
+        classes = 1 - self.uses_atis[reps, actors]
+        tt = self.total_travel_time[reps, actors]
+        n = self.trip_n[reps, classes] + 1
+        delta = tt - self.trip_mean[reps, classes]
+        mean = self.trip_mean[reps, classes] + delta / n
+        self.trip_m2[reps, classes] += delta * (tt - mean)
+        self.trip_n[reps, classes] = n
+        self.trip_mean[reps, classes] = mean
+        self.trip_max[reps, classes] = np.maximum(self.trip_max[reps, classes], tt)
+
+    def start_edge(self, reps: np.ndarray, actors: np.ndarray, ts: np.ndarray, edges: np.ndarray) -> np.ndarray:
+        """EdgeStartEvent, for one actor per replication at most. Returns the times the edges end at"""
+        self.count_edges(reps, actors, edges, ts, 1)
+        first = self.edges_first_use[reps, edges] < 0
+        self.edges_first_use[reps[first], edges[first]] = self.steps
+
+        tt = congestion_time_estimates(self.free_flow[edges], self.capacity[reps, edges],
+                                       self.volume[reps, edges])
+        self.volume[reps, edges] += 1
+
+        # running statistics of the edge travel times
+        n = self.tt_n[reps, edges] + 1
+        delta = tt - self.tt_mean[reps, edges]
+        mean = self.tt_mean[reps, edges] + delta / n
+        self.tt_m2[reps, edges] += delta * (tt - mean)
+        self.tt_n[reps, edges] = n
+        self.tt_mean[reps, edges] = mean
+        self.tt_max[reps, edges] = np.maximum(self.tt_max[reps, edges], tt)
+
+        end_times = ts + tt
+        atis = self.uses_atis[reps, actors] & (end_times < self.max_run_time)
+        self.atis_volume[reps[atis], edges[atis]] += 1
+        self.edges_travel_time[reps, actors] += tt
+        return end_times
+
+    def end_edge(self, reps: np.ndarray, actors: np.ndarray, ts: np.ndarray, edges: np.ndarray) -> np.ndarray:
+        """EdgeEndEvent, for one actor per replication at most, but for the choice of the next edge.
+        Returns the mask of the actors that did not reach their destination"""
+        self.count_edges(reps, actors, edges, ts, -1)
+        self.atis_volume[reps, edges] -= self.uses_atis[reps, actors]
+        self.node[reps, actors] = self.edge_dest[edges]
+        self.hops[reps, actors] += 1
+        self.volume[reps, edges] -= 1
+
+        done = self.node[reps, actors] == self.graph.nend
+        self.total_travel_time[reps[done], actors[done]] = self.edges_travel_time[reps[done], actors[done]]
+        self.add_trip_times(reps[done], actors[done])
+        self.count_actors(reps[done], actors[done], ts[done], -1)
+        return ~done
+
+    def next_edges(self, reps: np.ndarray, actors: np.ndarray, ts: np.ndarray) -> np.ndarray:
+        """Next edge of each actor, from its base route or from the atis"""
+        edges = self.base_routes[self.route_choice[reps, actors], self.hops[reps, actors]]
+        atis = self.uses_atis[reps, actors]
+        if np.any(atis):
+            edges[atis] = self.get_edge_predictions(reps[atis], self.node[reps[atis], actors[atis]], ts[atis])
+        return edges
+
+    def get_routes(self, nodes: np.ndarray) -> np.ndarray:
+        """Rows of the routes table of the given nodes, looking up the routes of new nodes"""
+        rows = []
+        for node in nodes.tolist():
+            row = self.route_rows.get(node)
+            if row is None:
+                row = self.add_routes(node)
+            rows.append(row)
+        return np.array(rows, dtype=int)
+
+    def add_routes(self, node: int) -> int:
+        routes = self.graph.get_possible_edge_routes(node, self.graph.nend)
+        n_rows, n_routes, length = self.route_table.shape
+        n_routes = max(n_routes, len(routes))
+        length = max([length] + [len(r) for r in routes])
+
+        table = np.full((n_rows + 1, n_routes, length), self.num_edges, dtype=int)
+        padding = np.full((n_rows + 1, n_routes), np.inf)
+        table[:n_rows, :self.route_table.shape[1], :self.route_table.shape[2]] = self.route_table
+        padding[:n_rows, :self.route_padding.shape[1]] = self.route_padding
+        for k, r in enumerate(routes):
+            table[n_rows, k, :len(r)] = r
+            padding[n_rows, k] = 0.0
+
+        self.route_table, self.route_padding = table, padding
+        row = self.route_rows[node] = n_rows
+        return row
+
+    def get_edge_predictions(self, reps: np.ndarray, nodes: np.ndarray, ts: np.ndarray) -> np.ndarray:
+        """Atis.get_edge_prediction through ExhaustiveRouting, for one actor per replication at most:
+        the first edge of the route costing the least, ties going to the first route"""
+        rows = self.get_routes(nodes)
+        routes = self.route_table[rows]
+        reps = reps[:, None, None]
+
+        if isinstance(self.atis, PrevisionAtis):
+            tt = self.get_prevision_costs(reps[:, :, 0], routes, ts)
+        else:
+            if isinstance(self.atis, AdherenceAtis):
+                volume = self.atis_volume[reps, routes] / self.atis.percentage_usage
+            elif isinstance(self.atis, CurrentAtis):
+                volume = self.volume[reps, routes]
+            else:
+                raise ValueError("unsupported atis: %s" % type(self.atis).__name__)
+            costs = congestion_time_estimates(self.free_flow[routes], self.capacity[reps, routes], volume)
+
+            # summed edge by edge, as the routing engine does
+            tt = np.zeros(routes.shape[:2])
+            for j in range(routes.shape[2]):
+                tt += costs[:, :, j]
+
+        tt += self.route_padding[rows]
+        best = np.argmin(tt, axis=1)
+        return routes[np.arange(len(rows)), best, 0]
+
+    def get_prevision_costs(self, reps: np.ndarray, routes: np.ndarray, ts: np.ndarray) -> np.ndarray:
+        """Travel times of the routes predicted by PrevisionAtis.iter_edge_costs, decided at ts"""
+        ts = ts[:, None]
+        timestamp = np.repeat(ts, routes.shape[1], axis=1)
+        tt = np.zeros(routes.shape[:2])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for j in range(routes.shape[2]):
+                edges = routes[:, :, j]
+                free_flow, capacity = self.free_flow[edges], self.capacity[reps, edges]
+                real = congestion_time_estimates(free_flow, capacity, self.volume[reps, edges])
+                cost = self.get_predicted_tt(free_flow, capacity, timestamp) * \
+                    (real / self.get_predicted_tt(free_flow, capacity, ts))
+                cost = np.where(edges == self.num_edges, 0.0, cost)
+                tt += cost
+                timestamp = timestamp + cost
+        return tt
+
+    def get_predicted_tt(self, free_flow: np.ndarray, capacity: np.ndarray, ts: np.ndarray) -> np.ndarray:
+        """PrevisionAtis.get_edge_predicted_tt of several edges, at the given timestamps"""
+        if self.atis.resolution <= 0:
+            return congestion_time_estimates(free_flow, capacity, self.get_demand(ts))
+
+        resolution = self.atis.resolution
+        bucket = np.floor_divide(ts, resolution).astype(int)
+        start = bucket * resolution
+        cost = congestion_time_estimates(free_flow, capacity, self.get_bucket_demand(bucket))
+        end_cost = congestion_time_estimates(free_flow, capacity, self.get_bucket_demand(bucket + 1))
+        return cost + (end_cost - cost) / resolution * (ts - start)
+
+    def get_demand(self, ts: np.ndarray) -> np.ndarray:
+        """DemandTable.exact of several timestamps"""
+        demand = self.atis.demand
+        return demand.td.pdf(ts) * demand.num_actors
+
+    def get_bucket_demand(self, bucket: np.ndarray) -> np.ndarray:
+        """DemandTable.at_bucket of several buckets"""
+        values = np.asarray(self.atis.demand.values)
+        inside = (bucket >= 0) & (bucket < len(values))
+        return np.where(inside, values[np.clip(bucket, 0, len(values) - 1)],
+                        self.get_demand(bucket * self.atis.resolution))
+
+    def get_summary(self, i: int) -> RunSummary:
+        """Summary of the i-th replication, as OnlineSimStats.get_summary"""
+        reached = self.node[i] == self.graph.nend
+        tt_atis, tt_natis = RunningStats(), RunningStats()
+        for c, rs in enumerate([tt_atis, tt_natis]):
+            rs.n, rs.mean, rs.m2, rs.max = int(self.trip_n[i, c]), self.trip_mean[i, c], \
+                self.trip_m2[i, c], self.trip_max[i, c]
+            # as OnlineSimStats.finish
+            rs.add_all(np.full(self.class_count[i, c], self.max_run_time))
+
+        used = np.flatnonzero(self.edges_first_use[i] >= 0)
+        used = used[np.argsort(self.edges_first_use[i, used])].tolist()
+        avg_edges, edges_tt, edges_class = {}, {}, {}
+        for e in used:
+            last_ts = self.edges_last_ts[i, e]
+            avg_edges[str(self.edges[e])] = self.edges_area[i, e] / last_ts if last_ts > 0 else 0.0
+            edges_class[str(self.edges[e])] = self.get_class_summary(
+                self.edges_class_area[i, e], self.edges_class_max[i, e], last_ts)
+            rs = edges_tt[str(self.edges[e])] = RunningStats()
+            rs.n, rs.mean, rs.m2, rs.max = int(self.tt_n[i, e]), self.tt_mean[i, e], \
+                self.tt_m2[i, e], self.tt_max[i, e]
+
+        last_ts = self.actors_last_ts[i]
+        return RunSummary(
+            actors_not_finishing=int(np.sum(~reached)),
+            avg_actors=self.actors_area[i] / last_ts if last_ts > 0 else 0.0,
+            avg_edges=avg_edges,
+            tt_atis=tt_atis,
+            tt_natis=tt_natis,
+            max_actors=int(self.max_actors[i]),
+            edges_tt=edges_tt,
+            class_actors=self.get_class_summary(self.class_area[i], self.class_max[i], last_ts),
+            edges_class=edges_class)
+
+    @staticmethod
+    def get_class_summary(area: np.ndarray, maxima: np.ndarray, last_ts: float) -> list:
+        """OnlineSimStats.get_class_summary of per class accumulators"""
+        if last_ts <= 0:
+            return [0.0, 0.0, int(maxima[0]), int(maxima[1])]
+        return [area[0] / last_ts, area[1] / last_ts, int(maxima[0]), int(maxima[1])]
+
+    def get_graph(self, i: int) -> RoadGraph:
+        """Road graph with the edges state of the i-th replication at the end of its run"""
+        graph = self.graph_constructor(self.graph.route_index)
+        graph.volume = self.volume[i, :-1].copy()
+        graph.atis_volume = self.atis_volume[i, :-1].copy()
+        graph.capacity = self.capacity[i, :-1].copy()
+        return graph
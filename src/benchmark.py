@@ -0,0 +1,183 @@
+"""
+Benchmarks of the simulation core.
+Fixed-seed scenarios are run over a matrix of number of actors, ATIS type,
+ATIS percentage and network, each case in its own process so that its peak
+memory is measured alone. Results can be saved as a baseline, and later runs
+compared against it to flag slowdowns.
+
+Usage: python src/benchmark.py [-o OUT.json] [-b BASELINE.json] [-t TOLERANCE]
+"""
+from itertools import product
+from typing import List
+
+from main import default_config, build_simulator, average_all_results
+
+import argparse
+import json
+import os.path
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+NUM_ACTORS = [200, 1000, 5000]
+ATIS_TYPES = [1, 2, 3]
+ATIS_PERCENTAGES = [0.2, 0.6]
+# 'hardcoded' stands for the default road network
+NETWORKS = ['hardcoded', 'grid:1000']
+# limit of the routes between two nodes on generated networks
+MAX_ROUTES = 5
+SEED = 42
+
+# metrics compared against the baseline, and whether higher is worse
+METRICS = {
+    'wall_time': True,
+    'run_time': True,
+    'aggregate_time': True,
+    'events_per_sec': False,
+    'peak_rss_mb': True
+}
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description='Simulation core benchmarks')
+    ap.add_argument('-n', '--num_actors', type=int, nargs='+', default=NUM_ACTORS,
+                    help='numbers of actors')
+    ap.add_argument('-at', '--atis_types', type=int, nargs='+', default=ATIS_TYPES,
+                    help='ATIS types (1: prevision, 2: real, 3: adherence)')
+    ap.add_argument('-ap', '--atis_percentages', type=float, nargs='+', default=ATIS_PERCENTAGES,
+                    help='percentages of actors using the ATIS')
+    ap.add_argument('-net', '--networks', type=str, nargs='+', default=NETWORKS,
+                    help="road networks, 'hardcoded' or as in main.py's --network")
+    ap.add_argument('-r', '--runs', type=int, default=1,
+                    help='replications simulated by each case')
+    ap.add_argument('-rep', '--repeat', type=int, default=1,
+                    help='times each case is measured, the fastest one is kept')
+    ap.add_argument('-o', '--output', type=str, default=None,
+                    help='file to save the results to, as a baseline')
+    ap.add_argument('-b', '--baseline', type=str, default=None,
+                    help='baseline to compare the results against')
+    ap.add_argument('-t', '--tolerance', type=float, default=0.2,
+                    help='relative slowdown from the baseline flagged as a regression')
+    ap.add_argument('--case', type=str, default=None, help=argparse.SUPPRESS)
+    return ap.parse_args()
+
+
+def benchmark_cases(args) -> List[dict]:
+    """All the cases of the benchmark matrix"""
+    return [{'num_actors': n, 'used_atis': a, 'atis_percentage': p, 'network': net, 'n_runs': args.runs}
+            for n, a, p, net in product(args.num_actors, args.atis_types,
+                                        args.atis_percentages, args.networks)]
+
+
+def case_key(case: dict) -> str:
+    return 'n%d_atis%d_p%g_%s_r%d' % (case['num_actors'], case['used_atis'], case['atis_percentage'],
+                                      case['network'], case['n_runs'])
+
+
+def run_case(case: dict) -> dict:
+    """Simulate a case in this process and measure it"""
+    network = None if case['network'] == 'hardcoded' else case['network']
+    config = default_config(num_actors=case['num_actors'], used_atis=case['used_atis'],
+                            atis_percentage=case['atis_percentage'], n_runs=case['n_runs'],
+                            network=network, max_routes=MAX_ROUTES if network else None,
+                            seed=SEED, plots=False)
+
+    start = time.perf_counter()
+    run_time, events, summaries = 0.0, 0, []
+    for run in range(config.n_runs):
+        sim = build_simulator(config)
+        run_start = time.perf_counter()
+        sim.run(run)
+        run_time += time.perf_counter() - run_start
+        events += sim.num_events
+
+        sim.stats.add_actors(sim.actors)
+        summaries.append(sim.stats.get_summary())
+
+    aggregate_start = time.perf_counter()
+    average_all_results(summaries, False)
+    aggregate_time = time.perf_counter() - aggregate_start
+
+    return {'wall_time': time.perf_counter() - start,
+            'run_time': run_time,
+            'aggregate_time': aggregate_time,
+            'events': events,
+            'events_per_sec': events / run_time if run_time > 0 else 0.0,
+            # kilobytes on linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def measure_case(case: dict, repeat: int) -> dict:
+    """Measure a case in fresh processes, keeping the fastest of the repetitions"""
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)],
+                             check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        metrics = json.loads(out.strip().splitlines()[-1])
+        if best is None or metrics['wall_time'] < best['wall_time']:
+            best = metrics
+    return best
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Cases and metrics that regressed by more than the tolerance, relatively to the baseline"""
+    regressions = []
+    for key, case in results['cases'].items():
+        base = baseline['cases'].get(key)
+        if base is None:
+            continue
+        for metric, higher_is_worse in METRICS.items():
+            new, old = case['metrics'][metric], base['metrics'][metric]
+            if old <= 0 or new <= 0:
+                continue
+            ratio = new / old if higher_is_worse else old / new
+            if ratio > 1 + tolerance:
+                regressions.append('%s: %s %.4g -> %.4g (x%.2f)' % (key, metric, old, new, ratio))
+    return regressions
+
+
+def print_results(results: dict):
+    print('%-40s %9s %9s %9s %12s %9s' % ('case', 'wall (s)', 'run (s)', 'aggr (s)', 'events/s', 'rss (MB)'))
+    for key, case in results['cases'].items():
+        m = case['metrics']
+        print('%-40s %9.3f %9.3f %9.3f %12.0f %9.1f' %
+              (key, m['wall_time'], m['run_time'], m['aggregate_time'], m['events_per_sec'], m['peak_rss_mb']))
+
+
+def main():
+    args = parse_args()
+
+    if args.case is not None:
+        # child process, measuring a single case
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    results = {'python': platform.python_version(),
+               'machine': platform.machine(),
+               'cases': {}}
+    for case in benchmark_cases(args):
+        key = case_key(case)
+        print('running %s' % key, file=sys.stderr)
+        results['cases'][key] = {'case': case, 'metrics': measure_case(case, args.repeat)}
+
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, 'w+') as fd:
+            json.dump(results, fd, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fd:
+            regressions = compare(results, json.load(fd), args.tolerance)
+        if regressions:
+            print('\nregressions over %d%%:' % round(args.tolerance * 100))
+            for r in regressions:
+                print('\t' + r)
+            sys.exit(1)
+        print('\nno regressions over %d%%' % round(args.tolerance * 100))
+
+
+if __name__ == '__main__':
+    main()
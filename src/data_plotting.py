@@ -2,6 +2,7 @@ from typing import List, Dict
 
 from ipdb import set_trace
 
+import math
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
@@ -26,11 +27,21 @@ def plot_accumulated_actor_graph(actors_flow_acc: List[List[float]], n_runs):
     plt.show()
 
 
+# edges plotted at most, the busiest ones on larger networks
+MAX_EDGE_PLOTS = 40
+
+
 def plot_accumulated_edges_graphs(edges_accumulated: Dict[str, List[List[float]]], n_runs):
-    """Plot the actors occupation of all edges during the simulation"""
+    """Plot the actors occupation of all edges during the simulation,
+    or of the MAX_EDGE_PLOTS edges with the highest peak occupation if there are more"""
     fig = plt.figure()
-    n_edges = len(edges_accumulated.keys())
     edge_list = sorted(list(edges_accumulated.keys()))
+    if len(edge_list) > MAX_EDGE_PLOTS:
+        peaks = {e_key: np.max(np.sum(np.array(edges_accumulated[e_key])[:, 1:], axis=1))
+                 for e_key in edge_list}
+        edge_list = sorted(sorted(edge_list, key=lambda e_key: -peaks[e_key])[:MAX_EDGE_PLOTS])
+        fig.suptitle('%d busiest of %d edges' % (MAX_EDGE_PLOTS, len(edges_accumulated)))
+    n_edges = len(edge_list)
     for i, e_key in enumerate(edge_list):
         edge_data = edges_accumulated[e_key]
         edge_data = np.array(edge_data)
@@ -39,7 +50,7 @@ def plot_accumulated_edges_graphs(edges_accumulated: Dict[str, List[List[float]]
 
         ax = fig.add_subplot(
             4,
-            int((n_edges / 4 + 0.5)),
+            math.ceil(n_edges / 4),
             i + 1
         )
         ax.text(.2, .9, str(e_key),
@@ -52,3 +63,22 @@ def plot_accumulated_edges_graphs(edges_accumulated: Dict[str, List[List[float]]
         plt.xlim(right=28)
 
     plt.show()
+
+
+def plot_edges_occupancy(edges_occupancy: Dict[str, List[float]]):
+    """Plot the average and max atis and non atis users of each edge,
+    given as [avg atis, avg non atis, max atis, max non atis]"""
+    edge_list = sorted(edges_occupancy.keys())
+    x = np.arange(len(edge_list))
+    data = np.array([edges_occupancy[e_key] for e_key in edge_list]).reshape(-1, 4)
+
+    pal = sns.color_palette("Set1")
+    fig, (avg_ax, max_ax) = plt.subplots(2, 1, sharex=True)
+    for ax, (atis, natis), name in [(avg_ax, data[:, :2].T, 'average actors'), (max_ax, data[:, 2:].T, 'max actors')]:
+        ax.bar(x - 0.2, atis, width=0.4, color=pal[0], alpha=0.4, label='atis')
+        ax.bar(x + 0.2, natis, width=0.4, color=pal[1], alpha=0.4, label='natis')
+        ax.set_ylabel(name)
+        ax.legend(loc='upper right')
+    max_ax.set_xticks(x)
+    max_ax.set_xticklabels(edge_list, rotation=90)
+    plt.show()
@@ -44,8 +44,7 @@ class CreateActorEvent(Event):
         self.actor_constructor = actor_constructor
 
     def act(self, sim: simulator.Simulator):
-        a = self.actor_constructor(sim.graph, sim.atis)
-        sim.actors.append(a)
+        a = self.actor_constructor(sim.graph, sim.atis, sim.actors)
 
         if sim.config.verbose:
             print("%f" % round(self.at_time, 5), " -- created actor %d | atis: %s" %
@@ -54,9 +53,7 @@ class CreateActorEvent(Event):
         # updating general stats only
         sim.stats.add_actor(self.at_time, a.uses_atis())
         a.start_trip(self.at_time)
-        return [EdgeStartEvent(self.at_time,
-                               a,
-                               a.get_next_travel_edge(self.at_time))]
+        return start_edge(sim, self.at_time, a, a.get_next_travel_edge(self.at_time))
 
 
 class EdgeStartEvent(Event):
@@ -70,17 +67,25 @@ class EdgeStartEvent(Event):
         self.edge = edge
 
     def act(self, sim: simulator.Simulator):
+        return EdgeStartEvent.begin(sim, self.at_time, self.actor, self.edge)
+
+    @staticmethod
+    def begin(sim: simulator.Simulator, at_time: float, a: actor.Actor, edge: Tuple[int, int]) -> List[Event]:
         """
         Updates simulator's statistics (e.g. increase load/traffic on edge).
         """
-        sim.stats.add_actor_edge(
-            self.at_time, self.edge, self.actor.uses_atis())
+        sim.stats.add_actor_edge(at_time, edge, a.uses_atis())
 
-        tt = sim.graph.get_edge_real_travel_time(self.edge)
-        sim.graph.add_vehicle(self.edge)
+        tt = sim.graph.get_edge_real_travel_time(edge)
+        sim.graph.add_vehicle(edge)
+        sim.stats.add_edge_travel_time(edge, tt)
 
-        self.actor.add_time_for_edge(self.edge, tt)
-        return [EdgeEndEvent(self.at_time + tt, self.actor, self.edge)]
+        # Atis users are only accounted for if their EdgeEndEvent gets scheduled
+        if a.uses_atis() and at_time + tt < sim.max_run_time:
+            sim.graph.add_atis_vehicle(edge)
+
+        a.add_time_for_edge(edge, tt)
+        return [EdgeEndEvent(at_time + tt, a, edge)]
 
 
 class EdgeEndEvent(Event):
@@ -101,22 +106,39 @@ class EdgeEndEvent(Event):
         sim.stats.remove_actor_edge(
             self.at_time, self.edge, self.actor.uses_atis())
 
+        if self.actor.uses_atis():
+            sim.graph.remove_atis_vehicle(self.edge)
+
         self.actor.travel(self.at_time, self.edge)
         sim.graph.remove_vehicle(self.edge)
 
         if not self.actor.reached_dest():
             # Time it starts next edge its equal to the time this event ended
-            return [EdgeStartEvent(self.at_time, self.actor, self.actor.get_next_travel_edge(self.at_time))]
+            return start_edge(sim, self.at_time, self.actor, self.actor.get_next_travel_edge(self.at_time))
 
         if sim.config.verbose:
             self.actor.print_traveled_route()
 
         # updating general stats
         self.actor.update_total_tt()
+        sim.stats.add_trip_time(self.actor.total_travel_time, self.actor.uses_atis())
         sim.stats.remove_actor(self.at_time, self.actor.uses_atis())
         return []
 
 
+def start_edge(sim: simulator.Simulator, at_time: float, a: actor.Actor, edge: Tuple[int, int]) -> List[Event]:
+    """
+    Starts travelling along an edge at the time of the current event.
+    An EdgeStartEvent scheduled now would be the next event dequeued if no other
+    event is pending until then, in which case it is handled right away instead.
+    """
+    if sim.can_fuse(at_time):
+        sim.num_events += 1
+        sim.fused_events += 1
+        return EdgeStartEvent.begin(sim, at_time, a, edge)
+    return [EdgeStartEvent(at_time, a, edge)]
+
+
 class AccidentEvent(Event):
     """Represents an unexpected negative event on the network (e.g. traffic accidents)"""
 
@@ -127,5 +149,5 @@ class AccidentEvent(Event):
         self.scale_factor = scale_factor
 
     def act(self, sim) -> List[Event]:
-        sim.graph.graph.edges[self.edge]['capacity'] *= self.scale_factor
+        sim.graph.scale_capacity(self.edge, self.scale_factor)
         return []
@@ -0,0 +1,281 @@
+"""
+Event calendars: the pending event set of a simulation run.
+Events are always dequeued by increasing timestamp. In the HeapCalendar,
+the CalendarQueue and the ArrivalStream, events sharing the same timestamp
+leave in insertion order (FIFO); the PriorityQueueCalendar instead settles
+them through the Event comparison operators (Event.__lt__ and Event.__eq__).
+"""
+from abc import ABC, abstractmethod
+from bisect import insort
+from itertools import chain
+from queue import PriorityQueue
+
+import heapq
+import numpy as np
+
+
+class EventCalendar(ABC):
+    """Class to encapsulate the different pending event set implementations"""
+
+    @abstractmethod
+    def push(self, event):
+        """Schedule the given event"""
+        pass
+
+    @abstractmethod
+    def pop(self):
+        """Remove and return the event with the smallest timestamp"""
+        pass
+
+    def reserve(self, n: int) -> int:
+        """Reserve the insertion order of n events that will be pushed later, through push_reserved,
+        as if they were pushed now (e.g. to tie-break them as initial events). Returns the first position"""
+        return 0
+
+    def push_reserved(self, event, position: int):
+        """Schedule the given event with a position obtained from reserve"""
+        self.push(event)
+
+    @abstractmethod
+    def peek_time(self) -> float:
+        """Timestamp of the event that would be dequeued next"""
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def __iter__(self):
+        """Iterate over the pending events, in no particular order"""
+        pass
+
+
+class PriorityQueueCalendar(EventCalendar):
+    """
+    The original thread-safe queue.PriorityQueue calendar.
+    Kept for comparison purposes: it takes a lock on every operation and
+    resolves timestamp ties through the Event comparison operators.
+    """
+
+    def __init__(self):
+        self.queue = PriorityQueue()
+
+    def push(self, event):
+        self.queue.put_nowait(event.get_priorized())
+
+    def pop(self):
+        return self.queue.get_nowait()[1]
+
+    def peek_time(self) -> float:
+        return self.queue.queue[0][0]
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def __getstate__(self):
+        # the queue locks can not be pickled, only its items
+        return {'items': list(self.queue.queue)}
+
+    def __setstate__(self, state):
+        self.queue = PriorityQueue()
+        self.queue.queue.extend(state['items'])
+
+    def __iter__(self):
+        return (ev for _, ev in self.queue.queue)
+
+
+class HeapCalendar(EventCalendar):
+    """Binary heap calendar, with a sequence number as tie-breaker"""
+
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+
+    def push(self, event):
+        self.seq += 1
+        heapq.heappush(self.heap, (event.at_time, self.seq, event))
+
+    def reserve(self, n: int) -> int:
+        self.seq += n
+        return self.seq - n + 1
+
+    def push_reserved(self, event, position: int):
+        heapq.heappush(self.heap, (event.at_time, position, event))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+    def peek_time(self) -> float:
+        return self.heap[0][0]
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        return (ev for _, _, ev in self.heap)
+
+
+class CalendarQueue(EventCalendar):
+    """
+    Calendar queue (R. Brown, 1988): events are hashed by timestamp into
+    'days' (buckets) of a fixed width, which are visited cyclically as a 'year'.
+    Enqueue and dequeue take O(1) amortized time when the bucket width
+    follows the events' separation, which is re-estimated on every resize.
+    """
+
+    MIN_BUCKETS = 2
+    SAMPLE_SIZE = 25
+
+    def __init__(self, n_buckets: int = MIN_BUCKETS, width: float = 1.0):
+        self.seq = 0
+        self.size = 0
+        self.last_day = 0    # absolute day of the last dequeued event
+        self._setup(n_buckets, width)
+
+    def _setup(self, n_buckets: int, width: float):
+        # (bucket, day) of the earliest event, as last found, until it is dequeued or preceded
+        self.found = None
+        self.n_buckets = n_buckets
+        self.width = width
+        self.buckets = [[] for _ in range(n_buckets)]
+        self.grow_at = 2 * n_buckets
+        self.shrink_at = n_buckets // 2 - 2
+
+    def _day(self, at_time: float) -> int:
+        return int(at_time // self.width)
+
+    def _insert(self, item):
+        day = self._day(item[0])
+        if self.found is not None and item < self.found[0][0]:
+            self.found = None
+        insort(self.buckets[day % self.n_buckets], item)
+        if day < self.last_day:
+            self.last_day = day
+
+    def push(self, event):
+        self.seq += 1
+        self.push_reserved(event, self.seq)
+
+    def reserve(self, n: int) -> int:
+        self.seq += n
+        return self.seq - n + 1
+
+    def push_reserved(self, event, position: int):
+        self._insert((event.at_time, position, event))
+        self.size += 1
+        if self.size > self.grow_at:
+            self._resize(2 * self.n_buckets)
+
+    def _find(self):
+        """Bucket holding the earliest event, and its day"""
+        if self.found is not None:
+            return self.found
+        self.found = self._scan()
+        return self.found
+
+    def _scan(self):
+        if self.size == 0:
+            raise IndexError("empty calendar")
+
+        day = self.last_day
+        for _ in range(self.n_buckets):
+            bucket = self.buckets[day % self.n_buckets]
+            if bucket and self._day(bucket[0][0]) == day:
+                return bucket, day
+            day += 1
+
+        # No event in the current year: jump directly to the earliest one
+        bucket = min((b for b in self.buckets if b), key=lambda b: b[0])
+        return bucket, self._day(bucket[0][0])
+
+    def pop(self):
+        return self._take(*self._find())
+
+    def peek_time(self) -> float:
+        bucket, _ = self._find()
+        return bucket[0][0]
+
+    def _take(self, bucket, day: int):
+        self.found = None
+        self.last_day = day
+        self.size -= 1
+        event = bucket.pop(0)[2]
+        if self.size < self.shrink_at:
+            self._resize(self.n_buckets // 2)
+        return event
+
+    def _resize(self, n_buckets: int):
+        items = [item for bucket in self.buckets for item in bucket]
+        self._setup(max(n_buckets, self.MIN_BUCKETS), self._estimate_width(items))
+        self.last_day = min(self._day(item[0]) for item in items) if items else 0
+        for item in items:
+            insort(self.buckets[self._day(item[0]) % self.n_buckets], item)
+
+    def _estimate_width(self, items) -> float:
+        """Three times the average separation of the earliest pending events"""
+        sample = [item[0] for item in heapq.nsmallest(self.SAMPLE_SIZE, items)]
+        gaps = [b - a for a, b in zip(sample, sample[1:]) if b > a]
+        return 3 * sum(gaps) / len(gaps) if gaps else self.width
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return (ev for bucket in self.buckets for _, _, ev in bucket)
+
+
+class ArrivalStream(EventCalendar):
+    """
+    Merges a sorted stream of arrivals with a calendar holding the other events,
+    so that the calendar only holds in-flight events. Arrival events are created
+    as they are dequeued, and leave before any other event with the same
+    timestamp, as if they were all pushed first.
+    """
+
+    def __init__(self, calendar: EventCalendar, times, make_event):
+        self.calendar = calendar
+        self.times = np.sort(np.asarray(times, dtype=float))
+        self.make_event = make_event
+        self.next = 0
+        self.next_time = self.times[0].item() if len(self.times) > 0 else float('inf')
+
+    def push(self, event):
+        self.calendar.push(event)
+
+    def reserve(self, n: int) -> int:
+        return self.calendar.reserve(n)
+
+    def push_reserved(self, event, position: int):
+        self.calendar.push_reserved(event, position)
+
+    def _calendar_time(self) -> float:
+        return self.calendar.peek_time() if len(self.calendar) > 0 else float('inf')
+
+    def pop(self):
+        if len(self.calendar) > 0 and self.calendar.peek_time() < self.next_time:
+            return self.calendar.pop()
+
+        event = self.make_event(self.next_time)
+        self.next += 1
+        self.next_time = self.times[self.next].item() if self.next < len(self.times) else float('inf')
+        return event
+
+    def peek_time(self) -> float:
+        return min(self.next_time, self._calendar_time())
+
+    def pending_arrivals(self) -> int:
+        return len(self.times) - self.next
+
+    def pending_arrival_times(self) -> np.ndarray:
+        """Timestamps of the arrivals not dequeued yet, in order"""
+        return self.times[self.next:]
+
+    def __len__(self):
+        return len(self.calendar) + self.pending_arrivals()
+
+    def __iter__(self):
+        """Iterate over the calendar events, then over the pending arrivals as events built on the fly:
+        these are only meant for inspection, and are not the ones pop will return
+        (see pending_arrival_times to avoid building them)"""
+        return chain(self.calendar, (self.make_event(t) for t in self.pending_arrival_times().tolist()))
@@ -3,43 +3,249 @@ Graph representing a road network.
 Graph topology should allow for dynamic run-time changes (e.g. accidents
 and other phenomena that restrict or even block a given edge).
 """
-from typing import List, Tuple
-from utils import congestion_time_estimate
+from typing import Dict, List, Tuple
+from utils import congestion_time_estimate, congestion_time_estimates
 
 import networkx as nx
+import numpy as np
+
+
+class RouteIndex:
+    """
+    Cache of the possible routes between pairs of nodes, stored both as
+    node lists and as arrays of edge ids. It is bound to a graph topology
+    and only invalidated when that topology changes.
+    """
+
+    topology: Tuple[Tuple[int, int], ...]
+    routes: Dict[Tuple[int, int], Tuple[List[List[int]], List[np.ndarray]]]
+    # free flow travel time of each route, and the routes order by it
+    bounds: Dict[Tuple[int, int], Tuple[List[int], List[float]]]
+
+    def __init__(self):
+        self.topology = None
+        self.routes = {}
+        self.bounds = {}
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, topology: Tuple[Tuple[int, int], ...]):
+        """Associate the index to a topology, dropping the cached routes if it changed"""
+        if topology != self.topology:
+            self.topology = topology
+            self.routes = {}
+            self.bounds = {}
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
 
 
 class RoadGraph:
+    """
+    Road network. The edges state lives in contiguous arrays indexed by the
+    edge id, networkx is only used to build the network and to export it.
+    """
 
     graph: nx.DiGraph
     nstart: int
     nend: int
+    edge_ids: Dict[Tuple[int, int], int]
+    successors: Dict[int, List[int]]
+    route_index: RouteIndex
 
-    def __init__(self):
-        self.hardcoded_graph_2()
+    # cost factor applied to the edges of a route when looking for alternatives to it
+    ROUTE_PENALTY = 1.5
+
+    # incremented whenever an edge capacity (or the topology) changes
+    capacity_version: int
+    # incremented whenever an edge volume or capacity changes
+    state_version: int
+    # incremented whenever an edge atis volume or capacity changes
+    atis_state_version: int
+
+    # edges state, indexed by edge id
+    volume: np.ndarray
+    capacity: np.ndarray
+    free_flow: np.ndarray
+    # number of atis users currently traveling each edge
+    atis_volume: np.ndarray
+
+    def __init__(self, route_index: RouteIndex = None, network=None, max_routes: int = None):
+        """
+        A route_index from a previous graph can be given, it is reused if the topology is the same.
+        The network (see networks.RoadNetwork) defaults to the hardcoded one. If max_routes is set,
+        only max_routes alternative routes between two nodes are considered,
+        instead of every simple path, which is unfeasible on large networks.
+        """
+        self.route_index = route_index if route_index is not None else RouteIndex()
+        self.max_routes = max_routes
+        self.capacity_version = 0
+        self.state_version = 0
+        self.atis_state_version = 0
+        if network is None:
+            self.hardcoded_graph_2()
+        else:
+            self.load_network(network)
+
+    def topology_changed(self):
+        """Re-index the edges and invalidate the cached routes. Must follow any structural change"""
+        self.edge_ids = {e: i for i, e in enumerate(self.graph.edges)}
+        self.successors = {n: list(self.graph.successors(n)) for n in self.graph.nodes}
+        self.route_index.bind(tuple(self.edge_ids))
+
+        edges_data = [self.graph.edges[e] for e in self.edge_ids]
+        self.volume = np.array([d.get('volume', 0) for d in edges_data], dtype=int)
+        self.capacity = np.array([d['capacity'] for d in edges_data], dtype=float)
+        self.free_flow = np.array([d['free_flow_travel_time'] for d in edges_data], dtype=float)
+        self.atis_volume = np.array([d.get('atis_volume', 0) for d in edges_data], dtype=int)
+        self.capacity_version += 1
+        self.state_version += 1
+        self.atis_state_version += 1
+
+    def store_edges_state(self):
+        """Write the edges state arrays back to the networkx graph attributes"""
+        for e, i in self.edge_ids.items():
+            self.graph.edges[e].update(volume=int(self.volume[i]),
+                                       capacity=self.capacity[i].item(),
+                                       free_flow_travel_time=self.free_flow[i].item(),
+                                       atis_volume=int(self.atis_volume[i]))
+
+    def to_networkx(self) -> nx.DiGraph:
+        """Export the road network, with its current state, as a networkx graph"""
+        g = nx.DiGraph()
+        g.add_nodes_from(self.graph.nodes)
+        for e, i in self.edge_ids.items():
+            g.add_edge(e[0], e[1],
+                       volume=int(self.volume[i]),
+                       free_flow_travel_time=self.free_flow[i].item(),
+                       capacity=self.capacity[i].item())
+        return g
+
+    def add_edge(self, edge: Tuple[int, int], free_flow_travel_time: float, capacity: float):
+        """Add a new road to the network"""
+        self.store_edges_state()
+        self.graph.add_edge(edge[0], edge[1], volume=0,
+                            free_flow_travel_time=free_flow_travel_time,
+                            capacity=capacity)
+        self.topology_changed()
+
+    def remove_edge(self, edge: Tuple[int, int]):
+        """Remove a road from the network"""
+        self.store_edges_state()
+        self.graph.remove_edge(edge[0], edge[1])
+        self.topology_changed()
 
     def __print_edge_volumes(self):
         """Pretty print of the edges current volumes. Useful for debug purposes"""
         print("Volumes:")
-        for e in self.graph.edges:
-            print("\t(%i, %i) -> %i" %
-                (e[0], e[1], self.graph.edges[e[0], e[1]]['volume']))
+        for e, i in self.edge_ids.items():
+            print("\t(%i, %i) -> %i" % (e[0], e[1], self.volume[i]))
 
     def add_vehicle(self, edge: (int, int)):
         """Add a vehicle to a given edge"""
-        self.graph.edges[edge[0], edge[1]]['volume'] += 1
+        self.volume[self.edge_ids[edge]] += 1
+        self.state_version += 1
 
     def remove_vehicle(self, edge: (int, int)):
         """Remove a vehicle from a given edge"""
-        self.graph.edges[edge[0], edge[1]]['volume'] -= 1
+        self.volume[self.edge_ids[edge]] -= 1
+        self.state_version += 1
+
+    def add_atis_vehicle(self, edge: (int, int)):
+        """Add an atis user to a given edge"""
+        self.atis_volume[self.edge_ids[edge]] += 1
+        self.atis_state_version += 1
+
+    def remove_atis_vehicle(self, edge: (int, int)):
+        """Remove an atis user from a given edge"""
+        self.atis_volume[self.edge_ids[edge]] -= 1
+        self.atis_state_version += 1
+
+    def get_edge_atis_volume(self, edge: Tuple[int, int]) -> int:
+        """Get the number of atis users traveling a given edge"""
+        return self.atis_volume[self.edge_ids[edge]]
+
+    def scale_capacity(self, edge: Tuple[int, int], factor: float):
+        """Scale the capacity of a given edge (e.g. due to an accident)"""
+        self.capacity[self.edge_ids[edge]] *= factor
+        self.capacity_version += 1
+        self.state_version += 1
+        self.atis_state_version += 1
 
     def get_edge_data(self, edge: Tuple[int, int]) -> dict:
         """Get edge related data. ATIS data endpoint"""
-        return self.graph.edges[edge[0], edge[1]]
+        i = self.edge_ids[edge]
+        return {'volume': self.volume[i],
+                'capacity': self.capacity[i],
+                'free_flow_travel_time': self.free_flow[i],
+                'atis_volume': self.atis_volume[i]}
+
+    def get_indexed_routes(self, src_node: int, dest_node: int) -> Tuple[List[List[int]], List[np.ndarray]]:
+        """Get the (node lists, edge id arrays) of all routes from src_node to dest_node"""
+        key = (src_node, dest_node)
+        entry = self.route_index.routes.get(key)
+        if entry is not None:
+            self.route_index.hits += 1
+            return entry
+
+        self.route_index.misses += 1
+        if self.max_routes is None:
+            routes = list(nx.all_simple_paths(self.graph, src_node, dest_node))
+        else:
+            routes = self.get_alternative_routes(src_node, dest_node, self.max_routes)
+        edge_routes = [np.array([self.edge_ids[e] for e in zip(r, r[1:])], dtype=int)
+                       for r in routes]
+        entry = self.route_index.routes[key] = (routes, edge_routes)
+        return entry
+
+    def get_alternative_routes(self, src_node: int, dest_node: int, k: int) -> List[List[int]]:
+        """
+        Get up to k alternative routes from src_node to dest_node, fastest (free flow) first.
+        Routes are found by repeated shortest path searches, penalizing the edges of the routes
+        already found, which unlike exact k shortest paths scales to large networks.
+        """
+        penalty = {}
+
+        def weight(u, v, data):
+            return data['free_flow_travel_time'] * penalty.get((u, v), 1.0)
+
+        routes = []
+        for _ in range(2 * k):
+            route = nx.dijkstra_path(self.graph, src_node, dest_node, weight=weight)
+            if route not in routes:
+                routes.append(route)
+                if len(routes) == k:
+                    break
+            for e in zip(route, route[1:]):
+                penalty[e] = penalty.get(e, 1.0) * self.ROUTE_PENALTY
+
+        return sorted(routes, key=self.get_optimal_route_travel_time)
 
-    def get_possible_routes(self, src_node: int, dest_node: int):
-        """Get all possible routes from the src_node to the destiny_node"""
-        return list(nx.all_simple_paths(self.graph, src_node, dest_node))
+    def get_successors(self, node: int) -> List[int]:
+        """Get the nodes directly reachable from the given node"""
+        return self.successors[node]
+
+    def get_possible_routes(self, src_node: int, dest_node: int) -> List[List[int]]:
+        """Get all possible routes from the src_node to the destiny_node.
+        The returned lists are shared by the route index and must not be modified"""
+        return self.get_indexed_routes(src_node, dest_node)[0]
+
+    def get_possible_edge_routes(self, src_node: int, dest_node: int) -> List[np.ndarray]:
+        """Get all possible routes from the src_node to the destiny_node, as arrays of edge ids"""
+        return self.get_indexed_routes(src_node, dest_node)[1]
+
+    def get_route_bounds(self, src_node: int, dest_node: int) -> Tuple[List[int], List[float]]:
+        """Get the free flow travel time of each route from src_node to dest_node, a lower bound
+        of its travel time, along with the route indexes sorted by it"""
+        key = (src_node, dest_node)
+        entry = self.route_index.bounds.get(key)
+        if entry is None:
+            routes = self.get_possible_routes(src_node, dest_node)
+            bounds = [self.get_optimal_route_travel_time(r) for r in routes]
+            order = sorted(range(len(routes)), key=lambda i: (bounds[i], i))
+            entry = self.route_index.bounds[key] = (order, bounds)
+        return entry
 
     def get_all_routes(self) -> List[List[int]]:
         # results in [[0, 1, 3], [0, 2, 1, 3], [0, 2, 3]]
@@ -51,21 +257,41 @@ class RoadGraph:
         """Gets the estimated optimal travel time it takes to transverse a given route"""
         edges = list(zip(route, route[1:]))
 
-        estimates = [self.graph.edges[e[0], e[1]]['free_flow_travel_time']
-                     for e in edges]
+        estimates = [self.free_flow[self.edge_ids[e]] for e in edges]
 
         return sum(estimates)
 
     def get_edge_travel_time(self, edge: Tuple[int, int], volume: int) -> float:
         """Get the time it takes to transverse the edge, considering a given volume"""
-        edge_data = self.get_edge_data(edge)
-        return congestion_time_estimate(edge_data['free_flow_travel_time'],
-                                        edge_data['capacity'],
-                                        volume)
+        i = self.edge_ids[edge]
+        return congestion_time_estimate(self.free_flow[i], self.capacity[i], volume)
 
     def get_edge_real_travel_time(self, edge: Tuple[int, int]) -> float:
         """Get the real actual time it takes to transverse the edge (congestion included)"""
-        return self.get_edge_travel_time(edge, self.get_edge_data(edge)['volume'])
+        i = self.edge_ids[edge]
+        return congestion_time_estimate(self.free_flow[i], self.capacity[i], self.volume[i])
+
+    def get_edges_travel_time(self, edge_ids: np.ndarray, volumes: np.ndarray) -> np.ndarray:
+        """Get the time it takes to transverse several edges (given by id), considering the given volumes"""
+        return congestion_time_estimates(self.free_flow[edge_ids], self.capacity[edge_ids], volumes)
+
+    def get_edges_real_travel_time(self, edge_ids: np.ndarray = None) -> np.ndarray:
+        """Get the real actual time it takes to transverse several edges (all, by default)"""
+        if edge_ids is None:
+            return congestion_time_estimates(self.free_flow, self.capacity, self.volume)
+        return self.get_edges_travel_time(edge_ids, self.volume[edge_ids])
+
+    def load_network(self, network):
+        """Build the graph from an edge list network (see networks.RoadNetwork)"""
+        self.graph = nx.DiGraph()
+        self.graph.add_nodes_from(np.unique(network.edges).tolist())
+        self.nstart = network.nstart
+        self.nend = network.nend
+        self.graph.add_edges_from(
+            (u, v, {'volume': vol, 'free_flow_travel_time': ff, 'capacity': cap})
+            for (u, v), ff, cap, vol in zip(network.edges.tolist(), network.free_flow.tolist(),
+                                            network.capacity.tolist(), network.volume.tolist()))
+        self.topology_changed()
 
     def hardcoded_graph_1(self):
         """Hardcoded deliverable 2 example graph for now"""
@@ -78,6 +304,7 @@ class RoadGraph:
             volume=0,
             free_flow_travel_time=1,
             capacity=20)
+        self.topology_changed()
 
     def hardcoded_graph_2(self):
         """A different hardcoded graph, see Xavier's EcoBook"""
@@ -103,3 +330,4 @@ class RoadGraph:
             volume=0,
             free_flow_travel_time=0.92,
             capacity=50)  # other recommended path
+        self.topology_changed()
@@ -3,24 +3,28 @@ Main project source file.
 """
 from typing import List, Tuple
 
-from actor import Actor
-from data_plotting import plot_accumulated_actor_graph, plot_accumulated_edges_graphs
+from actor import ActorFactory
+from data_plotting import plot_accumulated_actor_graph, plot_accumulated_edges_graphs, plot_edges_occupancy
 from simulator import Simulator
+from batch import BatchSimulator
 from graph import RoadGraph
-from queue import PriorityQueue
-from utils import softmax_travel_times, compute_average_over_time, MultimodalDistribution
-from atis import PrevisionAtis, CurrentAtis, AdherenceAtis, Atis
-from statistics import SimStats
-from ipdb import set_trace
-from pprint import pprint
+from networks import load_network
+from event_calendar import HeapCalendar, CalendarQueue, PriorityQueueCalendar
+from utils import MultimodalDistribution
+from atis import PrevisionAtis, CurrentAtis, AdherenceAtis
+from routing import ExhaustiveRouting, ShortestPathRouting
+from results_io import RESULT_FORMATS, save_results
+from profiling import SimProfiler
+from statistics import SimStats, OnlineSimStats, RunSummary, RunningStats, confidence_interval
 from collections import defaultdict
-from tqdm import trange
+from tqdm import tqdm
 from functools import partial
+from multiprocessing import Pool
 
 
 import argparse
+import gc
 import numpy as np
-import json
 import os.path
 import networkx as nx
 
@@ -28,10 +32,28 @@ PREVISION_ATIS = 1
 REAL_ATIS = 2
 ADHERENCE_ATIS = 3
 
+EVENT_CALENDARS = {
+    'heap': HeapCalendar,
+    'calendar': CalendarQueue,
+    'priority': PriorityQueueCalendar
+}
 
-def parse_args():
-    parser = argparse.ArgumentParser(
-        description='Systems Modelling and Simulation')
+ROUTING_ENGINES = {
+    'exhaustive': ExhaustiveRouting,
+    'shortest': ShortestPathRouting,
+    'partial_routes': partial(ShortestPathRouting, all_partial_routes=True)
+}
+
+# alternative routes considered between two nodes on a given network, unless set with --max_routes
+NETWORK_MAX_ROUTES = 5
+
+# metrics whose confidence intervals decide when enough replications were run
+ADAPTIVE_METRICS = ['time_atis_yes', 'time_atis_no', 'avg_actors']
+
+
+def build_parser(description: str = 'Systems Modelling and Simulation') -> argparse.ArgumentParser:
+    """Command line options of a simulation"""
+    parser = argparse.ArgumentParser(description=description)
 
     parser.add_argument("-n", "--num_actors", default=500, type=int, metavar="N",
                         help="number of vehicles/actors to generate per simulation run")
@@ -52,6 +74,10 @@ def parse_args():
                         dest='traffic_peaks', metavar=("TPEAK_MEAN", "TPEAK_STD"),
                         help="mean and standard deviation of a normal distribution that represents a peak in traffic")
 
+    parser.add_argument("-acc", "--accident", type=float, nargs=4, action='append', dest='accidents',
+                        metavar=("TIME", "SRC", "DEST", "FACTOR"),
+                        help="accident at the given time (in hours) scaling the capacity of the edge (SRC, DEST)")
+
     parser.add_argument("-o", "--out_file", type=str, default=os.path.join("src", "results", "default.json"),
                         dest='save_path', metavar="SAVE_PATH",
                         help="place to save the result of running the simulations")
@@ -64,15 +90,125 @@ def parse_args():
                         const=3, help="ATIS will make use of other atis users' data to estimate the fastest route")
     parser.set_defaults(used_atis=2)
 
+    parser.add_argument("-rt", "--routing", default="exhaustive", choices=ROUTING_ENGINES.keys(),
+                        help="route search used by the ATIS: every simple path, (time-dependent) shortest path, "
+                             "exact under FIFO costs only, or shortest path over every simple partial route, "
+                             "exact for the prevision ATIS but exponential in the worst case")
+
+    parser.add_argument("-pr", "--prevision_resolution", default=0.0, type=float, metavar="HOURS",
+                        help="time resolution of the demand table and edge costs cache of the prevision ATIS, "
+                             "0 for exact predictions")
+
+    parser.add_argument("-q", "--event_queue", default="heap", choices=EVENT_CALENDARS.keys(),
+                        help="pending event set implementation used by the simulator")
+
+    parser.add_argument("-os", "--online_stats", dest='online_stats', action="store_true",
+                        help="accumulate the statistics as the simulation runs, in constant memory, without the flow series")
+    parser.set_defaults(online_stats=False)
+
+    parser.add_argument("-net", "--network", default=None, type=str, metavar="NETWORK",
+                        help="road network: an edge list file or a synthetic network spec, kind:n_edges[:seed] "
+                             "(e.g. grid:10000 or ring:1000), instead of the hardcoded one")
+
+    parser.add_argument("-mr", "--max_routes", default=None, type=int, metavar="K",
+                        help="only consider K alternative routes between two nodes, 0 for every simple path "
+                             "(default: every simple path on the hardcoded network, %d with --network)"
+                             % NETWORK_MAX_ROUTES)
+
+    parser.add_argument("-ci", "--target_ci", default=None, type=float, metavar="REL_WIDTH",
+                        help="instead of a fixed number of runs, add runs until the confidence intervals of the "
+                             "ATIS and non ATIS travel times and of the average actors are narrower than "
+                             "REL_WIDTH (half width relative to the mean, e.g. 0.01)")
+
+    parser.add_argument("-cl", "--confidence", default=0.95, type=float, metavar="LEVEL",
+                        help="confidence level of the intervals of --target_ci")
+
+    parser.add_argument("-mnr", "--min_runs", default=5, type=int, metavar="R",
+                        help="runs simulated before the confidence intervals are first checked")
+
+    parser.add_argument("-mxr", "--max_runs", default=100, type=int, metavar="R",
+                        help="runs after which to stop even if the confidence intervals are still too wide")
+
+    parser.add_argument("-f", "--format", default="json", choices=RESULT_FORMATS, dest="results_format",
+                        help="results file format: a single json file, or a json manifest along a raw binary array file")
+
+    parser.add_argument("-s", "--seed", default=42, type=int, metavar="SEED",
+                        help="seed from which the random stream of each run is derived")
+
+    parser.add_argument("-w", "--workers", default=1, type=int, metavar="N",
+                        help="number of processes the runs are spread across")
+
+    parser.add_argument("-ca", "--checkpoint_at", type=float, nargs="+", default=None, metavar="TIME",
+                        help="simulation times (in hours) at which to checkpoint each run")
+
+    parser.add_argument("-cf", "--checkpoint_file", type=str, default="checkpoint_run{run}_t{time}.ckpt",
+                        metavar="PATTERN", help="checkpoint files, {run} and {time} are replaced by the "
+                                                "replication and simulation time")
+
+    parser.add_argument("-rs", "--resume", type=str, default=None, metavar="CHECKPOINT",
+                        help="resume the run saved to the given checkpoint, instead of running from the start")
+
+    parser.add_argument("-bt", "--batch", dest='batch', action="store_true",
+                        help="simulate the runs in lockstep, vectorized across them (implies online statistics, "
+                             "only exhaustive routing); spread across the workers in as many batches")
+
+    parser.add_argument("-prof", "--profile", nargs="?", const="-", default=None, metavar="PROFILE_PATH",
+                        help="profile the runs: time per event type and atis method, event queue usage. "
+                             "The report is printed, or saved to PROFILE_PATH (as json if it ends in .json)")
+
     parser.add_argument("-v", "--verbose", dest='verbose', action="store_true",
                         help="allow helpful prints to be displayed")
     parser.set_defaults(verbose=False)
 
     parser.add_argument("-pl", "--plots", dest='plots', action="store_true",
                         help="display plots at the end of the simulation regarding the network occupation")
+    parser.add_argument("-npl", "--no-plots", dest='plots', action="store_false",
+                        help="do not display the plots, e.g. on large networks")
     parser.set_defaults(plots=True)
 
-    return parser.parse_args()
+    return parser
+
+
+def set_max_routes(config: argparse.Namespace):
+    """Every simple path between two nodes is only listed on the hardcoded network,
+    or if asked for (0), as there are exponentially many on larger ones"""
+    if config.max_routes is None and config.network:
+        config.max_routes = NETWORK_MAX_ROUTES
+    elif config.max_routes == 0:
+        config.max_routes = None
+
+
+def parse_args(argv: List[str] = None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.max_routes is not None and args.max_routes < 0:
+        parser.error("--max_routes must not be negative")
+    set_max_routes(args)
+    if args.batch:
+        if args.routing != 'exhaustive':
+            parser.error("--batch only supports exhaustive routing")
+        if args.checkpoint_at or args.resume or args.profile:
+            parser.error("--batch runs can not be checkpointed, resumed or profiled")
+        args.online_stats = True
+    if args.target_ci is not None:
+        if args.target_ci <= 0 or not 0 < args.confidence < 1:
+            parser.error("--target_ci must be positive and --confidence within (0, 1)")
+        if not 2 <= args.min_runs <= args.max_runs:
+            parser.error("--min_runs must be at least 2 and at most --max_runs")
+        if args.resume:
+            parser.error("a resumed run can not be replicated until --target_ci")
+    return args
+
+
+def default_config(**overrides) -> argparse.Namespace:
+    """Get the default command line configuration, with the given fields overridden"""
+    config = parse_args([])
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    set_max_routes(config)
+    if config.traffic_peaks is None:
+        config.traffic_peaks = [(8, 3), (18, 3)]
+    return config
 
 
 def print_args(args):
@@ -82,72 +218,60 @@ def print_args(args):
     print()
 
 
-def actor_constructor(use_atis_p: float, graph: RoadGraph, atis: Atis):
-    """Calculate possible routes and give each one a probability based on how little time it takes to transverse it"""
-    possible_routes = graph.get_all_routes()
-    routes_times = [graph.get_optimal_route_travel_time(r)
-                    for r in possible_routes]
-    routes_probs = softmax_travel_times(routes_times)
-    idx = np.random.choice(len(possible_routes), p=routes_probs)
-    return Actor(
-        possible_routes[idx],
-        np.random.choice([atis, None], p=[use_atis_p, 1-use_atis_p]))
-
-
-def atis_constructor(used_atis: bool, use_atis_p: float, num_actors: int, graph: RoadGraph, traffic_dist: MultimodalDistribution, events: PriorityQueue):
+def atis_constructor(used_atis: bool, use_atis_p: float, num_actors: int, routing: str,
+                     prevision_resolution: float, max_run_time: float,
+                     graph: RoadGraph, traffic_dist: MultimodalDistribution):
     # print("Created ATIS")
+    engine = ROUTING_ENGINES[routing]()
     switcher = {
-        PREVISION_ATIS: PrevisionAtis(graph, use_atis_p, traffic_dist, num_actors),
-        REAL_ATIS: CurrentAtis(graph, use_atis_p),
-        ADHERENCE_ATIS: AdherenceAtis(graph, use_atis_p, events)
+        PREVISION_ATIS: PrevisionAtis(graph, use_atis_p, traffic_dist, num_actors, engine,
+                                      prevision_resolution, max_run_time),
+        REAL_ATIS: CurrentAtis(graph, use_atis_p, engine),
+        ADHERENCE_ATIS: AdherenceAtis(graph, use_atis_p, engine)
     }
     return switcher.get(used_atis, "Invalid Atis")
 
 
-def stats_constructor(graph: RoadGraph):
+def stats_constructor(online: bool, graph: RoadGraph):
     # print("Created STATS")
-    return SimStats(graph)
+    return OnlineSimStats(graph) if online else SimStats(graph)
 
 
-def statistics_print(sim: Simulator):
+def statistics_print(summary: RunSummary):
     """Print of simulation statistics regarding ATIS and non ATIS users"""
     print()
-    atis_yes, atis_no = [], []
-    for a in sim.actors:
-        if a.atis is not None:
-            atis_yes.append(a.total_travel_time)
-        else:
-            atis_no.append(a.total_travel_time)
+    atis_yes = merge_travel_times([summary.tt_atis])
+    atis_no = merge_travel_times([summary.tt_natis])
+
+    print("ATIS YES: mean: %f || std: %f" % tuple(atis_yes))
+    print("ATIS NO: mean: %f || std: %f" % tuple(atis_no))
+
 
-    print("ATIS YES: mean: %f || std: %f" %
-          (np.mean(atis_yes), np.std(atis_yes)))
-    print("ATIS NO: mean: %f || std: %f" % (np.mean(atis_no), np.std(atis_no)))
+def merge_travel_times(all_tt: List) -> List[float]:
+    """Mean and std of the travel times of several runs, given as arrays or as running statistics"""
+    if len(all_tt) > 0 and isinstance(all_tt[0], RunningStats):
+        merged = RunningStats.merged(all_tt)
+        return [merged.mean, merged.std()] if merged.n > 0 else [np.nan, np.nan]
 
+    tt = np.hstack(all_tt)
+    return [np.mean(tt), np.std(tt)] if len(tt) > 0 else [np.nan, np.nan]
 
-def average_all_results(all_s: List[SimStats], display_plots: bool):
-    """Gather information regarding all runs and its metrics"""
+
+def merge_summaries(all_s: List[RunSummary]) -> dict:
+    """Gather the summary metrics of all runs"""
 
     # gather summary information
-    actors_wo_end = [
-        len([1 for a in stats.actors if not a.reached_dest()]) for stats in all_s]
+    actors_wo_end = [s.actors_not_finishing for s in all_s]
     avg_actors_not_finishing = np.sum(actors_wo_end) / len(all_s)
 
-    actors_summary = [compute_average_over_time(
-        stats.actors_in_graph) for stats in all_s]
-    edges_summary = [{str(e): compute_average_over_time(stats.edges_flow_over_time[e])
-                      for e in stats.edges_flow_over_time} for stats in all_s]
-
-    # gather atis information
-    atis_yes = np.hstack(
-        [[a.total_travel_time for a in stats.actors if a.atis is not None] for stats in all_s])
-    atis_no = np.hstack(
-        [[a.total_travel_time for a in stats.actors if a.atis is None] for stats in all_s])
+    actors_summary = [s.avg_actors for s in all_s]
+    edges_summary = [s.avg_edges for s in all_s]
 
     results = {'avg_actors_not_finishing': avg_actors_not_finishing,
                'avg_actors': [np.mean(actors_summary), np.std(actors_summary)],
                'avg_edges': defaultdict(lambda: []),
-               'time_atis_yes': [np.mean(atis_yes), np.std(atis_yes)] if len(atis_yes) > 0 else [np.nan, np.nan],
-               'time_atis_no': [np.mean(atis_no), np.std(atis_no)] if len(atis_no) > 0 else [np.nan, np.nan]}
+               'time_atis_yes': merge_travel_times([s.tt_atis for s in all_s]),
+               'time_atis_no': merge_travel_times([s.tt_natis for s in all_s])}
 
     for d in edges_summary:
         for d_k in d:
@@ -157,35 +281,103 @@ def average_all_results(all_s: List[SimStats], display_plots: bool):
         e: [np.mean(results['avg_edges'][e]), np.std(results['avg_edges'][e])] for e in results['avg_edges']
     }
 
+    if all_s[0].is_online():
+        max_actors = [s.max_actors for s in all_s]
+        results['max_actors'] = [np.mean(max_actors), np.std(max_actors)]
+
+        edges_tt = defaultdict(lambda: [])
+        for s in all_s:
+            for e_key, rs in s.edges_tt.items():
+                edges_tt[e_key].append(rs)
+        edges_tt = {e_key: RunningStats.merged(rss) for e_key, rss in edges_tt.items()}
+        results['edges_travel_time'] = {
+            e_key: [rs.mean, rs.std(), rs.max] for e_key, rs in edges_tt.items()
+        }
+
+        # average and max atis and non atis users, in the network and per edge
+        class_actors = np.array([s.class_actors for s in all_s], dtype=float)
+        for i, key in enumerate(['avg_actors_atis', 'avg_actors_natis', 'max_actors_atis', 'max_actors_natis']):
+            results[key] = [np.mean(class_actors[:, i]), np.std(class_actors[:, i])]
+
+        edges_class = defaultdict(lambda: [])
+        for s in all_s:
+            for e_key, values in s.edges_class.items():
+                edges_class[e_key].append(values)
+        results['edges_occupancy'] = {
+            e_key: np.mean(values, axis=0).tolist() for e_key, values in edges_class.items()
+        }
+
+    return results
+
+
+def accumulate_flows(flows: List[np.ndarray], groups: List[int] = None, n_groups: int = 1,
+                     as_rows: bool = True) -> List[List[list]]:
+    """
+    Merge (time, atis delta, non atis delta) flow series into cumulative
+    [time, atis users, non atis users] series, one per group (e.g. edge).
+    Each series is assigned to the given group (all to group 0 by default);
+    within a group, rows are ordered by time and ties keep the series order.
+    Series are lists of rows, or (k, 3) float arrays if as_rows is not set.
+    """
+    if groups is None:
+        groups = [0] * len(flows)
+    flow = np.concatenate(flows)
+    group = np.repeat(groups, [len(f) for f in flows])
+
+    # single stable sort by (group, time)
+    order = np.lexsort((flow[:, 0], group))
+    flow, group = flow[order], group[order]
+
+    # cumulative sums restarting at every group
+    acc = np.cumsum(flow[:, 1:].astype(int), axis=0)
+    bounds = np.searchsorted(group, np.arange(n_groups + 1))
+    offsets = np.vstack([np.zeros((1, 2), dtype=int), acc[bounds[1:-1] - 1]])
+    acc -= np.repeat(offsets, np.diff(bounds), axis=0)
+
+    if not as_rows:
+        series = np.column_stack((flow[:, 0], acc))
+        return [series[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    # rows as [float, int, int] lists, as expected by the json output
+    rows = np.empty((len(flow), 3), dtype=object)
+    rows[:, 0] = flow[:, 0]
+    rows[:, 1:] = acc
+
+    # the garbage collector would otherwise scan every new row on creation
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return [rows[start:end].tolist() for start, end in zip(bounds[:-1], bounds[1:])]
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def average_all_results(all_s: List[RunSummary], display_plots: bool, as_rows: bool = True):
+    """Gather information regarding all runs and its metrics.
+    Flow series are kept as arrays, instead of lists of rows, if as_rows is not set"""
+    results = merge_summaries(all_s)
+
+    if all_s[0].is_online():
+        # online statistics keep no flow series, only their summary is plotted
+        if display_plots:
+            plot_edges_occupancy(results['edges_occupancy'])
+        return results
+
     # gather new information with atis separation
-    actors_flow = [actor_tuple for s in all_s for actor_tuple in s.actors_atis]
-    actors_flow = sorted(actors_flow, key=lambda t: t[0])
-    actors_flow_acc = [[0.0, 0, 0]]
-    for actor_tuple in actors_flow:
-        actors_flow_acc.append([actor_tuple[0],
-                                actor_tuple[1] + actors_flow_acc[-1][1],
-                                actor_tuple[2] + actors_flow_acc[-1][2]])
-    actors_flow_acc = actors_flow_acc[1:]
+    actors_flow_acc = accumulate_flows([s.actors_atis for s in all_s], as_rows=as_rows)[0]
     results['actors_atis_natis'] = actors_flow_acc
 
-    # the above but for every edge
-    results['edges_atis_natis'] = defaultdict(lambda: [])
-    for s in all_s:
-        edges = s.edges_flow_atis
-        for key in edges.keys():
-            results['edges_atis_natis'][str(key)].append(edges[key])
-
-    for e_key in results['edges_atis_natis'].keys():
-        edge_flow = [edge_tuple for edges in results['edges_atis_natis'][e_key]
-                     for edge_tuple in edges]
-        edge_flow = sorted(edge_flow, key=lambda t: t[0])
-        edge_flow_acc = [[0.0, 0, 0]]
-        for edge_tuple in edge_flow:
-            edge_flow_acc.append([edge_tuple[0],
-                                  edge_tuple[1] + edge_flow_acc[-1][1],
-                                  edge_tuple[2] + edge_flow_acc[-1][2]])
-        edge_flow_acc = edge_flow_acc[1:]
-        results['edges_atis_natis'][e_key] = edge_flow_acc
+    # the above but for every edge, all edges at once
+    edge_keys = list(dict.fromkeys(key for s in all_s for key in s.edges_flow_atis))
+    edges_flow = [s.edges_flow_atis[key] for s in all_s for key in s.edges_flow_atis]
+    edges_idx = {key: i for i, key in enumerate(edge_keys)}
+    edges_group = [edges_idx[key] for s in all_s for key in s.edges_flow_atis]
+
+    edges_flow_acc = accumulate_flows(edges_flow, edges_group, len(edge_keys), as_rows)
+    results['edges_atis_natis'] = {
+        str(key): flow_acc for key, flow_acc in zip(edge_keys, edges_flow_acc)
+    }
 
     if display_plots:
         plot_accumulated_actor_graph(actors_flow_acc, len(all_s))
@@ -194,6 +386,160 @@ def average_all_results(all_s: List[SimStats], display_plots: bool):
     return results
 
 
+def parse_accidents(accidents: List[List[float]]) -> List[Tuple[float, Tuple[int, int], float]]:
+    """Accidents given as [time, src, dest, factor] to (time, edge, factor) tuples"""
+    return [(at_time, (int(src), int(dest)), factor) for at_time, src, dest, factor in accidents or []]
+
+
+def build_simulator(args) -> Simulator:
+    """Create a simulator for the given configuration"""
+    return Simulator(config=args,
+                     actor_constructor=ActorFactory(args.atis_percentage),
+                     atis_constructor=partial(
+                         atis_constructor, args.used_atis, args.atis_percentage, args.num_actors, args.routing,
+                         args.prevision_resolution, args.max_run_time),
+                     stats_constructor=partial(stats_constructor, args.online_stats),
+                     traffic_distribution=MultimodalDistribution(*args.traffic_peaks),
+                     calendar_constructor=EVENT_CALENDARS[args.event_queue],
+                     graph_constructor=partial(
+                         RoadGraph,
+                         network=load_network(args.network) if args.network else None,
+                         max_routes=args.max_routes),
+                     accidents=parse_accidents(args.accidents),
+                     seed=args.seed)
+
+
+def run_replication(args, run: int, export_graph: bool = True) -> RunSummary:
+    """Simulate a single run (replication) of the given configuration, with its own random stream.
+    Unless disabled, the graph of the last run is exported along with its summary.
+    The run is checkpointed at the configured times, or resumed from a checkpoint if configured so"""
+    sim = build_simulator(args)
+    profiler = SimProfiler() if getattr(args, 'profile', None) else None
+
+    if getattr(args, 'resume', None):
+        sim.restore(args.resume)
+        run = sim.replication
+    else:
+        sim.start(run)
+
+    for at_time in sorted(getattr(args, 'checkpoint_at', None) or []):
+        if sim.now < at_time < args.max_run_time:
+            sim.advance(at_time, profiler)
+            sim.checkpoint(args.checkpoint_file.format(run=run, time=at_time))
+
+    sim.advance(profiler=profiler)
+    sim.finish()
+    sim.stats.add_actors(sim.actors)
+
+    summary = sim.stats.get_summary()
+    summary.profile = profiler
+    if export_graph and (run == args.n_runs - 1 or getattr(args, 'resume', None)):
+        summary.graph = nx.readwrite.jit_data(sim.graph.to_networkx())
+    return summary
+
+
+def build_batch_simulator(args, replications: List[int]) -> BatchSimulator:
+    """Create a lockstep simulator of the given replications of a configuration"""
+    return BatchSimulator(config=args,
+                          replications=replications,
+                          actor_constructor=ActorFactory(args.atis_percentage),
+                          atis_constructor=partial(
+                              atis_constructor, args.used_atis, args.atis_percentage, args.num_actors,
+                              args.routing, args.prevision_resolution, args.max_run_time),
+                          traffic_distribution=MultimodalDistribution(*args.traffic_peaks),
+                          graph_constructor=partial(
+                              RoadGraph,
+                              network=load_network(args.network) if args.network else None,
+                              max_routes=args.max_routes),
+                          accidents=parse_accidents(args.accidents),
+                          seed=args.seed)
+
+
+def run_batch(args, replications: List[int]) -> List[RunSummary]:
+    """Simulate the given replications in lockstep, exporting the graph of the last run if among them"""
+    sim = build_batch_simulator(args, replications)
+    summaries = sim.run()
+    if args.n_runs - 1 in replications:
+        last = replications.index(args.n_runs - 1)
+        summaries[last].graph = nx.readwrite.jit_data(sim.get_graph(last).to_networkx())
+    return summaries
+
+
+def run_replications(args, replications: List[int] = None) -> List[RunSummary]:
+    """Run the given replications (all of them by default) of the given configuration, across args.workers
+    processes. Summaries are returned in the replications order, regardless of the number of workers.
+    When resuming from a checkpoint, only its replication is run"""
+    runs = partial(run_replication, args)
+    if args.resume:
+        return [runs(None)]
+
+    replications = list(range(args.n_runs)) if replications is None else replications
+    if args.batch:
+        batches = [b.tolist() for b in np.array_split(np.array(replications), max(args.workers, 1)) if len(b) > 0]
+        if len(batches) == 1:
+            return run_batch(args, batches[0])
+        with Pool(len(batches)) as pool:
+            return [s for summaries in pool.map(partial(run_batch, args), batches) for s in summaries]
+
+    if args.workers <= 1:
+        return [runs(r) for r in tqdm(replications, leave=False)]
+
+    with Pool(args.workers) as pool:
+        return list(tqdm(pool.imap(runs, replications), total=len(replications), leave=False))
+
+
+def metric_values(all_s: List[RunSummary]) -> dict:
+    """Values of each of the ADAPTIVE_METRICS over the runs"""
+    return {metric: np.array([s.get_metric(metric) for s in all_s]) for metric in ADAPTIVE_METRICS}
+
+
+def confidence_intervals(all_s: List[RunSummary], confidence: float) -> dict:
+    """Mean and half width of the confidence interval of each of the ADAPTIVE_METRICS over the runs"""
+    return {metric: confidence_interval(values, confidence) for metric, values in metric_values(all_s).items()}
+
+
+def runs_needed(values: dict, cis: dict, target: float) -> int:
+    """Estimated number of runs for the half widths of the confidence intervals cis to be at most
+    target times the means of the metrics values; as many as were run if they already are.
+    Metrics with less than two values are not accounted"""
+    n = max(len(v) for v in values.values())
+    needed = n
+    for metric, (_, half_width) in cis.items():
+        metric_v = values[metric][~np.isnan(values[metric])]
+        if np.isnan(half_width) or len(metric_v) == 0 or np.mean(metric_v) == 0:
+            continue
+        # the half width shrinks as the square root of the runs
+        needed = max(needed, int(np.ceil(n * (half_width / (target * abs(np.mean(metric_v)))) ** 2)))
+    return needed
+
+
+def replications_needed(all_s: List[RunSummary], target: float, confidence: float) -> int:
+    """Estimated number of runs for the confidence intervals of the runs to be narrow enough (see runs_needed).
+    Each configuration is judged on its own here, the pairing of configurations under
+    common random numbers is only done by the sweeps (see sweep.py)"""
+    return runs_needed(metric_values(all_s), confidence_intervals(all_s, confidence), target)
+
+
+def run_adaptive_replications(args) -> List[RunSummary]:
+    """Run replications, in rounds, until the confidence intervals of the ADAPTIVE_METRICS are narrower than
+    args.target_ci or args.max_runs were run. args.n_runs is updated to the runs so far"""
+    all_s = []
+    n_runs = args.min_runs
+    while len(all_s) < n_runs:
+        args.n_runs = n_runs
+        all_s += run_replications(args, list(range(len(all_s), n_runs)))
+        needed = replications_needed(all_s, args.target_ci, args.confidence)
+        # early estimates are noisy, the runs are at most doubled per round
+        n_runs = min(needed, 2 * n_runs, args.max_runs)
+    return all_s
+
+
+def ci_print(cis: dict, n_runs: int, confidence: float):
+    print("%d runs, %g%% confidence intervals:" % (n_runs, 100 * confidence))
+    for metric, (mean, half_width) in cis.items():
+        print("\t%s: %f +- %f (%.2f%%)" % (metric, mean, half_width, 100 * half_width / abs(mean)))
+
+
 def main(args):
     if args.traffic_peaks is None:
         # Needed since "action=append" doesn't overwrite "default=X"
@@ -201,27 +547,30 @@ def main(args):
 
     print_args(args)
 
-    sim = Simulator(config=args,
-                    actor_constructor=partial(
-                        actor_constructor, args.atis_percentage),
-                    atis_constructor=partial(
-                        atis_constructor, args.used_atis, args.atis_percentage, args.num_actors),
-                    stats_constructor=stats_constructor,
-                    traffic_distribution=MultimodalDistribution(*args.traffic_peaks))
-
     # gather stats from all runs
-    all_stats = []
-    for _ in trange(args.n_runs, leave=False):
-        sim.run()
-        sim.stats.add_actors(sim.actors)
-        all_stats.append(sim.stats)
-
-    json_object = average_all_results(all_stats, args.plots)
-    json_object['graph'] = nx.readwrite.jit_data(sim.graph.graph)
-
-    json.dump(json_object, open(args.save_path, "w+"))
-
-    statistics_print(sim)
+    if args.target_ci is not None:
+        all_summaries = run_adaptive_replications(args)
+    else:
+        all_summaries = run_replications(args)
+
+    results = average_all_results(all_summaries, args.plots, as_rows=args.results_format == 'json')
+    results['graph'] = all_summaries[-1].graph
+    if args.target_ci is not None:
+        cis = confidence_intervals(all_summaries, args.confidence)
+        results['confidence_intervals'] = {metric: list(ci) for metric, ci in cis.items()}
+
+    save_results(args.save_path, results, args)
+
+    statistics_print(all_summaries[-1])
+    if args.target_ci is not None:
+        ci_print(cis, len(all_summaries), args.confidence)
+
+    if args.profile:
+        profiler = SimProfiler.merged([s.profile for s in all_summaries])
+        if args.profile == '-':
+            print(profiler.report())
+        else:
+            profiler.save(args.profile)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+"""
+Road networks other than the hardcoded ones: loading and saving of compact
+edge list files, and deterministic synthetic grid and ring-radial networks
+of any size, to see how the simulation scales with the network.
+
+Edge list files are plain text (optionally gzipped): comment lines start with
+'#', the first line holds the origin and destination nodes of the trips, and
+every other line an edge, "u v free_flow_travel_time capacity [volume]".
+
+Usage: python src/networks.py {grid,ring} N_EDGES [-s SEED] [-o PATH]
+"""
+from functools import lru_cache
+from typing import Tuple
+
+import argparse
+import gzip
+import math
+import numpy as np
+
+# free flow travel time of the fastest trip in the hardcoded graph, which
+# synthetic networks are scaled to, so that trips fit a simulation day
+TRIP_TIME = 3.4
+CAPACITY_RANGE = (40, 60)
+
+
+class RoadNetwork:
+    """Edge list of a road network, along with the trips origin and destination"""
+
+    edges: np.ndarray
+    free_flow: np.ndarray
+    capacity: np.ndarray
+    volume: np.ndarray
+    nstart: int
+    nend: int
+
+    def __init__(self, edges, free_flow, capacity, nstart: int, nend: int, volume=None):
+        self.edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+        self.free_flow = np.asarray(free_flow, dtype=float)
+        self.capacity = np.asarray(capacity, dtype=float)
+        self.volume = np.zeros(len(self.edges), dtype=int) if volume is None \
+            else np.asarray(volume, dtype=int)
+        self.nstart = int(nstart)
+        self.nend = int(nend)
+
+    def __len__(self) -> int:
+        return len(self.edges)
+
+    def num_nodes(self) -> int:
+        return len(np.unique(self.edges))
+
+
+def _open(path: str, mode: str):
+    return gzip.open(path, mode + 't') if path.endswith('.gz') else open(path, mode)
+
+
+def read_edge_list(path: str) -> RoadNetwork:
+    """Read a road network from an edge list file"""
+    with _open(path, 'r') as fd:
+        header = next(line for line in fd if line.strip() and not line.startswith('#'))
+        nstart, nend = (int(v) for v in header.split())
+        data = np.loadtxt(fd, comments='#', ndmin=2)
+
+    volume = data[:, 4] if data.shape[1] > 4 else None
+    return RoadNetwork(data[:, :2], data[:, 2], data[:, 3], nstart, nend, volume)
+
+
+def write_edge_list(path: str, network: RoadNetwork):
+    """Write a road network to an edge list file"""
+    data = np.column_stack((network.edges, network.free_flow, network.capacity, network.volume))
+    with _open(path, 'w') as fd:
+        fd.write("# nstart nend, then: u v free_flow_travel_time capacity volume\n")
+        fd.write("%d %d\n" % (network.nstart, network.nend))
+        np.savetxt(fd, data, fmt=['%d', '%d', '%.17g', '%.17g', '%d'])
+
+
+def grid_network(rows: int, cols: int, seed: int = 0) -> RoadNetwork:
+    """
+    Grid of one way streets heading east and south, from the north-west
+    corner to the south-east one. Has 2 * rows * cols - rows - cols edges.
+    """
+    rng = np.random.RandomState(seed)
+    nodes = np.arange(rows * cols).reshape(rows, cols)
+    east = np.column_stack((nodes[:, :-1].ravel(), nodes[:, 1:].ravel()))
+    south = np.column_stack((nodes[:-1, :].ravel(), nodes[1:, :].ravel()))
+    edges = np.vstack((east, south))
+
+    hops = max(rows + cols - 2, 1)
+    free_flow = TRIP_TIME / hops * rng.uniform(0.8, 1.2, len(edges))
+    capacity = rng.randint(CAPACITY_RANGE[0], CAPACITY_RANGE[1] + 1, len(edges))
+    return RoadNetwork(edges, free_flow, capacity, nodes[0, 0], nodes[-1, -1])
+
+
+def ring_radial_network(rings: int, spokes: int, seed: int = 0) -> RoadNetwork:
+    """
+    Concentric rings of one way (clockwise) streets crossed by spokes heading out
+    of the center, from the center to the outer ring. Has 2 * rings * spokes edges.
+    """
+    rng = np.random.RandomState(seed)
+    # node 0 is the center, the others are indexed [ring, spoke]
+    nodes = 1 + np.arange(rings * spokes).reshape(rings, spokes)
+    center = np.column_stack((np.zeros(spokes, dtype=int), nodes[0]))
+    radial = np.column_stack((nodes[:-1].ravel(), nodes[1:].ravel()))
+    ring = np.column_stack((nodes.ravel(), np.roll(nodes, -1, axis=1).ravel()))
+    edges = np.vstack((center, radial, ring))
+
+    # radial edges have unit length, ring edges the length of their arc
+    radius = np.repeat(np.arange(1, rings + 1), spokes)
+    length = np.concatenate((np.ones(len(center) + len(radial)), 2 * math.pi * radius / spokes))
+    free_flow = TRIP_TIME / rings * length * rng.uniform(0.8, 1.2, len(edges))
+    capacity = rng.randint(CAPACITY_RANGE[0], CAPACITY_RANGE[1] + 1, len(edges))
+    return RoadNetwork(edges, free_flow, capacity, 0, nodes[-1, 0])
+
+
+def grid_shape(n_edges: int) -> Tuple[int, int]:
+    """Side of the square grid with about the given number of edges"""
+    side = max(2, round((1 + math.sqrt(1 + 2 * n_edges)) / 2))
+    return side, side
+
+
+def ring_radial_shape(n_edges: int) -> Tuple[int, int]:
+    """Rings and spokes of the ring-radial network with about the given number of edges"""
+    side = max(2, round(math.sqrt(n_edges / 2)))
+    return side, side
+
+
+GENERATORS = {
+    'grid': (grid_network, grid_shape),
+    'ring': (ring_radial_network, ring_radial_shape)
+}
+
+
+def generate_network(kind: str, n_edges: int, seed: int = 0) -> RoadNetwork:
+    """Synthetic network of the given kind with about the given number of edges"""
+    generator, shape = GENERATORS[kind]
+    return generator(*shape(n_edges), seed=seed)
+
+
+@lru_cache(maxsize=8)
+def load_network(spec: str) -> RoadNetwork:
+    """
+    Get the road network given either by an edge list file path or by a
+    "kind:n_edges[:seed]" generator spec (e.g. "grid:10000").
+    Networks are cached, and must not be modified.
+    """
+    kind, _, params = spec.partition(':')
+    if kind in GENERATORS and params:
+        n_edges, _, seed = params.partition(':')
+        return generate_network(kind, int(n_edges), int(seed) if seed else 0)
+    return read_edge_list(spec)
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description='Synthetic road network generator')
+    ap.add_argument('kind', choices=GENERATORS.keys(), help='network layout')
+    ap.add_argument('n_edges', type=int, help='approximate number of edges')
+    ap.add_argument('-s', '--seed', type=int, default=0,
+                    help='seed of the edges attributes')
+    ap.add_argument('-o', '--output', type=str, default=None,
+                    help='edge list file to write, defaults to <kind><n_edges>.txt')
+    return ap.parse_args()
+
+
+def main():
+    args = parse_args()
+    network = generate_network(args.kind, args.n_edges, args.seed)
+    output = args.output or '%s%d.txt' % (args.kind, args.n_edges)
+    write_edge_list(output, network)
+    print("%s: %d nodes, %d edges, from %d to %d" %
+          (output, network.num_nodes(), len(network), network.nstart, network.nend))
+
+
+if __name__ == '__main__':
+    main()
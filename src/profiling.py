@@ -0,0 +1,206 @@
+"""
+Opt-in instrumentation of simulation runs.
+A profiled run goes through a separate, instrumented, event loop, so runs
+that are not profiled pay nothing for it.
+"""
+from collections import defaultdict
+from typing import List
+
+import json
+import time
+
+# Atis methods timed when profiling, their times include the nested calls
+ATIS_METHODS = ['get_edge_prediction', 'get_predicted_tt_from_nodes', 'get_predicted_tt_from_edges',
+                'get_edge_cost', 'get_edge_predicted_tt']
+
+DECISION_METHOD = 'get_edge_prediction'
+
+
+class TimedMethod:
+    """Wrapper of a bound method that accounts its calls and time in a profiler"""
+
+    def __init__(self, profiler, key: str, method):
+        self.profiler = profiler
+        self.key = key
+        self.method = method
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        try:
+            return self.method(*args)
+        finally:
+            self.profiler.atis_time[self.key] += time.perf_counter() - start
+            self.profiler.atis_calls[self.key] += 1
+
+
+class SimProfiler:
+    """
+    Per event type counts and cumulative times, time spent on the event queue,
+    event queue high-water mark and calls and cumulative time of the Atis methods,
+    accumulated over all the profiled runs.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.run_time = 0.0
+        self.queue_time = 0.0
+        self.queue_high_water = 0
+        self.decision_hits = 0
+        self.decision_misses = 0
+        self.decision_forced = 0
+        self.edge_evaluations = 0
+        # edge starts handled right away, without going through the event queue
+        self.fused_events = 0
+        self.event_counts = defaultdict(int)
+        self.event_time = defaultdict(float)
+        self.atis_calls = defaultdict(int)
+        self.atis_time = defaultdict(float)
+
+    def instrument_atis(self, atis):
+        """Time the Atis methods, on this instance only"""
+        for name in ATIS_METHODS:
+            method = getattr(atis, name)
+            if isinstance(method, TimedMethod):
+                # already instrumented, e.g. by an earlier part of the run
+                method.profiler = self
+            else:
+                key = '%s.%s' % (type(atis).__name__, name)
+                setattr(atis, name, TimedMethod(self, key, method))
+
+    def simulate(self, sim, event_queue, until: float = float('inf')):
+        """Instrumented equivalent of the Simulator event loop"""
+        perf = time.perf_counter
+        atis = sim.atis
+        if atis is not None:
+            self.instrument_atis(atis)
+            hits, misses, forced = atis.decision_hits, atis.decision_misses, atis.decision_forced
+            evaluations = getattr(atis.routing, 'edge_evaluations', 0)
+
+        fused = sim.fused_events
+        # the high-water mark is of the events held by the calendar, not of the streamed arrivals
+        held = getattr(event_queue, 'calendar', event_queue)
+        start = perf()
+        num_events = 0
+        while len(event_queue) > 0 and event_queue.peek_time() < until:
+            t0 = perf()
+            event = event_queue.pop()
+            t1 = perf()
+            new_events = event.act(sim)
+            t2 = perf()
+            for ev in new_events:
+                if ev.get_timestamp() < sim.max_run_time:
+                    event_queue.push(ev)
+            t3 = perf()
+
+            num_events += 1
+            name = type(event).__name__
+            self.event_counts[name] += 1
+            self.event_time[name] += t2 - t1
+            self.queue_time += (t1 - t0) + (t3 - t2)
+            if len(held) > self.queue_high_water:
+                self.queue_high_water = len(held)
+
+        sim.num_events += num_events
+        self.run_time += perf() - start
+        self.fused_events += sim.fused_events - fused
+        if atis is not None:
+            self.decision_hits += atis.decision_hits - hits
+            self.decision_misses += atis.decision_misses - misses
+            self.decision_forced += atis.decision_forced - forced
+            self.edge_evaluations += getattr(atis.routing, 'edge_evaluations', 0) - evaluations
+        if len(event_queue) == 0:
+            self.runs += 1
+
+    def merge(self, other: 'SimProfiler'):
+        """Accumulate the measures of another profiler (e.g. of another replication)"""
+        self.runs += other.runs
+        self.run_time += other.run_time
+        self.queue_time += other.queue_time
+        self.queue_high_water = max(self.queue_high_water, other.queue_high_water)
+        self.decision_hits += other.decision_hits
+        self.decision_misses += other.decision_misses
+        self.decision_forced += other.decision_forced
+        self.edge_evaluations += other.edge_evaluations
+        self.fused_events += other.fused_events
+        for mine, theirs in [(self.event_counts, other.event_counts), (self.event_time, other.event_time),
+                             (self.atis_calls, other.atis_calls), (self.atis_time, other.atis_time)]:
+            for key, value in theirs.items():
+                mine[key] += value
+
+    @staticmethod
+    def merged(profilers: List['SimProfiler']) -> 'SimProfiler':
+        total = SimProfiler()
+        for p in profilers:
+            total.merge(p)
+        return total
+
+    def atis_decisions(self) -> int:
+        return sum(n for key, n in self.atis_calls.items() if key.endswith('.' + DECISION_METHOD))
+
+    def to_dict(self) -> dict:
+        decisions = self.atis_decisions()
+        decisions_time = sum(t for key, t in self.atis_time.items() if key.endswith('.' + DECISION_METHOD))
+        num_events = sum(self.event_counts.values()) + self.fused_events
+        return {
+            'runs': self.runs,
+            'run_time': self.run_time,
+            'events': num_events,
+            'events_per_sec': num_events / self.run_time if self.run_time > 0 else 0.0,
+            'queue_time': self.queue_time,
+            'queue_high_water': self.queue_high_water,
+            # included in events, their time is accounted to the event that created them
+            'fused_events': self.fused_events,
+            'event_types': {name: {'count': self.event_counts[name], 'time': self.event_time[name]}
+                            for name in sorted(self.event_counts)},
+            'atis_decisions': decisions,
+            # decisions per second of run, and per second spent deciding
+            'atis_decisions_per_sec': decisions / self.run_time if self.run_time > 0 else 0.0,
+            'atis_decision_rate': decisions / decisions_time if decisions_time > 0 else 0.0,
+            # decisions reused from the atis memo, as the state they depend on was unchanged
+            'atis_memo_hits': self.decision_hits,
+            'atis_memo_misses': self.decision_misses,
+            # decisions at nodes with a single way out, not looked up in the memo
+            'atis_forced_decisions': self.decision_forced,
+            # edge costs evaluated by the routing engine, if it counts them
+            'routing_edge_evaluations': self.edge_evaluations,
+            'atis_methods': {key: {'calls': self.atis_calls[key], 'time': self.atis_time[key]}
+                             for key in sorted(self.atis_calls)}
+        }
+
+    def report(self) -> str:
+        """Human readable report of the measures"""
+        d = self.to_dict()
+        lines = ['Profile of %d run(s): %.3fs, %d events (%.0f events/s)' %
+                 (d['runs'], d['run_time'], d['events'], d['events_per_sec']),
+                 '',
+                 '%-28s %10s %10s %8s %12s' % ('event type', 'count', 'time (s)', '%', 'us/event')]
+        for name, e in d['event_types'].items():
+            lines.append('%-28s %10d %10.3f %8.1f %12.2f' %
+                         (name, e['count'], e['time'], 100 * e['time'] / max(d['run_time'], 1e-12),
+                          1e6 * e['time'] / max(e['count'], 1)))
+        lines.append('%-28s %10s %10.3f %8.1f' %
+                     ('event queue', '', d['queue_time'], 100 * d['queue_time'] / max(d['run_time'], 1e-12)))
+        lines.append('event queue high-water mark: %d' % d['queue_high_water'])
+        lines.append('edge starts fused into the event before them: %d' % d['fused_events'])
+        lines.append('')
+        lines.append('atis decisions: %d (%.0f per second of run, %.0f per second deciding)' %
+                     (d['atis_decisions'], d['atis_decisions_per_sec'], d['atis_decision_rate']))
+        memo = d['atis_memo_hits'] + d['atis_memo_misses']
+        lines.append('atis decisions reused: %d of %d memo lookups (%.1f%%)' %
+                     (d['atis_memo_hits'], memo, 100 * d['atis_memo_hits'] / max(memo, 1)))
+        lines.append('atis decisions forced (single way out): %d' % d['atis_forced_decisions'])
+        if d['routing_edge_evaluations']:
+            lines.append('routing edge cost evaluations: %d' % d['routing_edge_evaluations'])
+        if d['atis_methods']:
+            lines.append('%-52s %10s %10s' % ('atis method (inclusive)', 'calls', 'time (s)'))
+            for key, m in d['atis_methods'].items():
+                lines.append('%-52s %10d %10.3f' % (key, m['calls'], m['time']))
+        return '\n'.join(lines)
+
+    def save(self, path: str):
+        """Write the measures to the given path, as json if it ends in .json, or as a text report"""
+        with open(path, 'w+') as fd:
+            if path.endswith('.json'):
+                json.dump(self.to_dict(), fd, indent=2)
+            else:
+                fd.write(self.report() + '\n')
@@ -0,0 +1,175 @@
+"""
+Reading and writing of simulation results.
+Results are either a single json file, or a small json manifest (configuration,
+graph and summary metrics) along a raw binary file holding the flow series,
+which is memory-mapped on load, so that only the series actually used are read.
+"""
+from typing import Dict, List
+
+import argparse
+import json
+import os.path
+import numpy as np
+import pandas as pd
+
+RESULT_FORMATS = ['json', 'binary']
+
+BINARY_FORMAT = 'hermes-binary'
+BINARY_VERSION = 1
+ARRAY_DTYPE = np.dtype('<f8')
+
+# results fields stored as arrays in the binary format
+SERIES_FIELDS = ['actors_atis_natis', 'edges_atis_natis']
+
+
+def save_results(path: str, results: dict, config: argparse.Namespace):
+    """Save the results of a simulation in the format given by the configuration"""
+    if getattr(config, 'results_format', 'json') == 'binary':
+        save_binary(path, results, config)
+    else:
+        save_json(path, results)
+
+
+def save_json(path: str, results: dict):
+    """Save the results as a single json file, flow series as lists of rows"""
+    results = dict(results)
+    for field in SERIES_FIELDS:
+        if field == 'edges_atis_natis' and field in results:
+            results[field] = {key: _as_rows(series) for key, series in results[field].items()}
+        elif field in results:
+            results[field] = _as_rows(results[field])
+
+    with open(path, "w+") as fd:
+        json.dump(results, fd)
+
+
+def _as_rows(series) -> List[list]:
+    """Flow series as [time, atis users, non atis users] rows"""
+    if isinstance(series, np.ndarray):
+        rows = np.empty(series.shape, dtype=object)
+        rows[:, 0] = series[:, 0]
+        rows[:, 1:] = series[:, 1:].astype(int)
+        return rows.tolist()
+    return series
+
+
+def get_data_path(path: str) -> str:
+    """Path of the binary file that goes along the given manifest"""
+    return os.path.splitext(path)[0] + '.bin'
+
+
+def save_binary(path: str, results: dict, config: argparse.Namespace):
+    """
+    Save the results as a json manifest at the given path, and their flow series
+    one after the other in a raw little-endian float64 file next to it.
+    The manifest keeps the dtype, shape and byte offset of every series.
+    """
+    manifest = {
+        'format': BINARY_FORMAT,
+        'version': BINARY_VERSION,
+        'data': os.path.basename(get_data_path(path)),
+        'config': vars(config),
+        'graph': results.get('graph'),
+        'results': {k: v for k, v in results.items() if k not in SERIES_FIELDS and k != 'graph'},
+        'arrays': {}
+    }
+
+    offset = 0
+    with open(get_data_path(path), 'wb') as fd:
+        def write_series(series) -> dict:
+            nonlocal offset
+            data = np.ascontiguousarray(series, dtype=ARRAY_DTYPE).reshape(-1, 3)
+            fd.write(data.tobytes())
+            entry = {'dtype': ARRAY_DTYPE.str, 'shape': list(data.shape), 'offset': offset}
+            offset += data.nbytes
+            return entry
+
+        if 'actors_atis_natis' in results:
+            manifest['arrays']['actors_atis_natis'] = write_series(results['actors_atis_natis'])
+        if 'edges_atis_natis' in results:
+            manifest['arrays']['edges_atis_natis'] = {
+                key: write_series(series) for key, series in results['edges_atis_natis'].items()
+            }
+
+    with open(path, 'w+') as fd:
+        json.dump(manifest, fd)
+
+
+def load_manifest(path: str) -> dict:
+    """Read a results file without its flow series.
+    Single json results files have to be parsed as a whole, but their series are dropped"""
+    with open(path) as fd:
+        content = json.load(fd)
+
+    if content.get('format') == BINARY_FORMAT:
+        return content
+
+    return {
+        'format': 'json',
+        'config': {},
+        'graph': content.get('graph'),
+        'results': {k: v for k, v in content.items() if k not in SERIES_FIELDS and k != 'graph'}
+    }
+
+
+def load_results(path: str) -> dict:
+    """
+    Load a results file, in any of the formats, as the dict written by the simulator.
+    Flow series of binary results are read-only arrays backed by a memory map of the data file.
+    """
+    with open(path) as fd:
+        content = json.load(fd)
+
+    if content.get('format') != BINARY_FORMAT:
+        return content
+
+    data_path = os.path.join(os.path.dirname(path), content['data'])
+    data = np.memmap(data_path, dtype=np.uint8, mode='r') if os.path.getsize(data_path) > 0 else b''
+
+    def read_series(entry: dict) -> np.ndarray:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        return np.frombuffer(data, dtype=dtype, count=count, offset=entry['offset']).reshape(entry['shape'])
+
+    results = dict(content['results'])
+    results['graph'] = content['graph']
+    arrays = content['arrays']
+    if 'actors_atis_natis' in arrays:
+        results['actors_atis_natis'] = read_series(arrays['actors_atis_natis'])
+    if 'edges_atis_natis' in arrays:
+        results['edges_atis_natis'] = {
+            key: read_series(entry) for key, entry in arrays['edges_atis_natis'].items()
+        }
+    return results
+
+
+def query_results(paths: List[str], fields: List[str] = None) -> pd.DataFrame:
+    """
+    Gather the configuration and summary metrics of many results files in a DataFrame,
+    one row per file, reading only their manifests. Metrics given as [mean, std]
+    are split in <metric>_mean and <metric>_std columns, as in a sweep.
+    If given, only the listed columns (besides the path) are kept.
+    """
+    rows = []
+    for path in paths:
+        manifest = load_manifest(path)
+        row = {'path': path}
+        row.update(manifest['config'])
+        row.update(_flatten_metrics(manifest['results']))
+        rows.append(row)
+
+    df = pd.DataFrame(rows)
+    if fields is not None:
+        df = df[['path'] + [f for f in fields if f != 'path']]
+    return df
+
+
+def _flatten_metrics(results: dict) -> Dict[str, float]:
+    """Scalar metrics, with [mean, std] pairs split in two columns"""
+    metrics = {}
+    for key, value in results.items():
+        if isinstance(value, list) and len(value) == 2:
+            metrics[key + '_mean'], metrics[key + '_std'] = value
+        elif not isinstance(value, (list, dict)):
+            metrics[key] = value
+    return metrics
@@ -0,0 +1,137 @@
+"""
+Routing engines used by the ATIS to choose the next edge of an actor.
+They only differ in how the candidate routes are explored, the cost of
+each edge is always given by the ATIS model.
+"""
+from abc import ABC, abstractmethod
+from itertools import count
+from typing import Tuple
+
+import heapq
+
+
+class RoutingEngine(ABC):
+    """Class to encapsulate the different route search strategies"""
+
+    @abstractmethod
+    def get_edge_prediction(self, atis, src_node: int, dest_node: int, timestamp: float) -> Tuple[int, int]:
+        """Get the first edge of the fastest route from 'src_node' to 'dest_node',
+        according to the given atis estimates"""
+        pass
+
+
+class ExhaustiveRouting(RoutingEngine):
+    """
+    Costs the simple paths between the two nodes. Exponential on the network size.
+    Routes are costed in order of their free flow travel time, edge by edge, and given up
+    on as soon as they cost more than the best one so far (branch and bound); the chosen
+    route is still the one costing every route would give, ties going to the first route.
+    """
+
+    def __init__(self):
+        # number of edge costs evaluated, across all decisions
+        self.edge_evaluations = 0
+
+    def get_edge_prediction(self, atis, src_node: int, dest_node: int, timestamp: float):
+        routes = atis.graph.get_possible_routes(src_node, dest_node)
+        order, bounds = atis.graph.get_route_bounds(src_node, dest_node)
+        use_bounds = atis.FREE_FLOW_BOUND
+
+        # routes are compared by (travel time, index), as in the list of possible routes
+        best_tt, best_idx = float('inf'), -1
+        evaluations = 0
+        for idx in order:
+            if use_bounds and (bounds[idx], idx) > (best_tt, best_idx):
+                if bounds[idx] > best_tt:
+                    # so are all the routes that follow
+                    break
+                continue
+
+            route = routes[idx]
+            tt = 0
+            for cost in atis.iter_edge_costs(zip(route, route[1:]), timestamp):
+                evaluations += 1
+                tt += cost
+                if (tt, idx) > (best_tt, best_idx):
+                    break
+            else:
+                best_tt, best_idx = tt, idx
+
+        self.edge_evaluations += evaluations
+        return tuple(routes[best_idx][:2])
+
+
+class ShortestPathRouting(RoutingEngine):
+    """
+    Label-setting (Dijkstra) search over the whole graph, one label per node, O(E log V) per decision.
+    Edges are costed at the time the actor is expected to reach them, so time-dependent models
+    (e.g. PrevisionAtis) are handled as well; the result is only exact as long as arriving later at
+    an edge never makes the actor leave it sooner (FIFO costs), which PrevisionAtis does not guarantee.
+    Unlike ExhaustiveRouting, the graph max_routes limit is ignored: every route is a candidate, so
+    both engines only choose among the same routes when there is no limit (e.g. the hardcoded network).
+    Ties between equally fast routes may be broken differently from ExhaustiveRouting.
+
+    With all_partial_routes set, time-dependent models are searched without assuming FIFO costs:
+    every simple partial route is a label, expanded cheapest first, which gives the result of
+    ExhaustiveRouting over every simple path, in exponential time in the worst case.
+    """
+
+    def __init__(self, all_partial_routes: bool = False):
+        self.all_partial_routes = all_partial_routes
+
+    def get_edge_prediction(self, atis, src_node: int, dest_node: int, timestamp: float):
+        if self.all_partial_routes and atis.TIME_DEPENDENT:
+            return self.get_partial_routes_prediction(atis, src_node, dest_node, timestamp)
+
+        graph = atis.graph
+        labels = {src_node: 0.0}
+        first_edges = {src_node: None}
+        settled = set()
+        seq = count()
+        heap = [(0.0, next(seq), src_node)]
+
+        while heap:
+            cost, _, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            if node == dest_node:
+                return first_edges[node]
+            settled.add(node)
+
+            for succ in graph.get_successors(node):
+                if succ in settled:
+                    continue
+                edge = (node, succ)
+                succ_cost = cost + atis.get_edge_cost(edge, timestamp + cost, timestamp)
+                if succ_cost < labels.get(succ, float('inf')):
+                    labels[succ] = succ_cost
+                    first_edges[succ] = first_edges[node] or edge
+                    heapq.heappush(heap, (succ_cost, next(seq), succ))
+
+        raise ValueError("node %d is unreachable from node %d" % (dest_node, src_node))
+
+    @staticmethod
+    def get_partial_routes_prediction(atis, src_node: int, dest_node: int, timestamp: float):
+        """
+        The cost of the rest of a route only depends on the time its first node is reached,
+        which is the cost so far: no partial route dominates another one, and they are all kept.
+        Costs are not negative, so the first route to reach the destination is the fastest one.
+        """
+        graph = atis.graph
+        seq = count()
+        # (cost, seq, nodes of the partial route)
+        heap = [(0.0, next(seq), (src_node,))]
+
+        while heap:
+            cost, _, route = heapq.heappop(heap)
+            node = route[-1]
+            if node == dest_node:
+                return route[0], route[1]
+
+            for succ in graph.get_successors(node):
+                if succ in route:
+                    continue
+                succ_cost = cost + atis.get_edge_cost((node, succ), timestamp + cost, timestamp)
+                heapq.heappush(heap, (succ_cost, next(seq), route + (succ,)))
+
+        raise ValueError("node %d is unreachable from node %d" % (dest_node, src_node))
@@ -0,0 +1,119 @@
+"""
+What-if studies of accidents.
+All the accident variants of a scenario share the same history up to the
+first accident, so it is simulated once per replication and snapshotted;
+every variant then continues from the snapshot, in parallel. The results
+are identical to simulating each variant from scratch (see main.py --accident).
+
+Usage: python src/scenarios.py -var TIME SRC DEST FACTOR [-var ...] [main.py options]
+"""
+from typing import List, Tuple
+from functools import partial
+from multiprocessing import Pool
+from tqdm import tqdm
+
+from main import build_parser, build_simulator, merge_summaries, set_max_routes
+from event import AccidentEvent
+from statistics import RunSummary
+
+
+# (time, edge, capacity scale factor)
+Accident = Tuple[float, Tuple[int, int], float]
+
+
+def simulate_prefix(args, run: int, variants: List[List[Accident]]) -> Tuple[bytes, int]:
+    """
+    Simulate a replication up to the first accident of all the variants, and snapshot it.
+    Insertion positions are reserved for the accidents of any variant, right after the
+    initial events, as they would be if scheduled from the start.
+    Returns the snapshot and the first reserved position.
+    """
+    sim = build_simulator(args)
+    sim.start(run)
+    first_position = sim.event_queue.reserve(max((len(v) for v in variants), default=0))
+
+    fork_time = min((at_time for v in variants for at_time, _, _ in v), default=args.max_run_time)
+    sim.advance(fork_time)
+    return sim.get_state(), first_position
+
+
+def run_variant(args, snapshot: bytes, first_position: int, accidents: List[Accident]) -> RunSummary:
+    """Simulate the rest of a replication, from its snapshot, with the given accidents"""
+    sim = build_simulator(args)
+    sim.set_state(snapshot)
+    for i, (at_time, edge, factor) in enumerate(accidents):
+        sim.event_queue.push_reserved(AccidentEvent(at_time, tuple(edge), factor), first_position + i)
+
+    sim.advance()
+    sim.finish()
+    sim.stats.add_actors(sim.actors)
+    return sim.stats.get_summary()
+
+
+def _run_task(args, task):
+    variant_idx, snapshot, first_position, accidents = task
+    return variant_idx, run_variant(args, snapshot, first_position, accidents)
+
+
+def fork_variants(args, variants: List[List[Accident]], workers: int = 1) -> List[List[RunSummary]]:
+    """
+    Simulate every accident variant (a list of accidents, possibly empty) over
+    args.n_runs replications, forking all of them from a shared prefix per replication.
+    Returns the summaries of each variant, in the replications order.
+    """
+    summaries = [[] for _ in variants]
+    if not variants:
+        return summaries
+
+    task = partial(_run_task, args)
+    pool = Pool(min(workers, len(variants))) if workers > 1 else None
+
+    try:
+        for run in tqdm(range(args.n_runs), leave=False):
+            snapshot, first_position = simulate_prefix(args, run, variants)
+            tasks = [(i, snapshot, first_position, v) for i, v in enumerate(variants)]
+            results = pool.map(task, tasks) if pool is not None else [task(t) for t in tasks]
+
+            for variant_idx, summary in results:
+                summaries[variant_idx].append(summary)
+    finally:
+        if pool is not None:
+            pool.close()
+
+    return summaries
+
+
+def parse_scenario_args():
+    parser = build_parser('Accident what-if scenarios')
+    parser.add_argument('-var', '--variant', type=float, nargs=4, action='append', dest='variants',
+                        metavar=('TIME', 'SRC', 'DEST', 'FACTOR'),
+                        help='a variant with a single accident, may be repeated')
+    parser.add_argument('-nb', '--no_baseline', action='store_true',
+                        help='do not simulate the variant without accidents')
+
+    args = parser.parse_args()
+    set_max_routes(args)
+    if args.traffic_peaks is None:
+        args.traffic_peaks = [(8, 3), (18, 3)]
+    return args
+
+
+def main():
+    args = parse_scenario_args()
+
+    variants = [[(at_time, (int(src), int(dest)), factor)]
+                for at_time, src, dest, factor in args.variants or []]
+    if not args.no_baseline:
+        variants.insert(0, [])
+
+    for variant, summaries in zip(variants, fork_variants(args, variants, args.workers)):
+        results = merge_summaries(summaries)
+        print()
+        print(variant if variant else 'no accidents')
+        for name, metric in [('ATIS YES', 'time_atis_yes'), ('ATIS NO', 'time_atis_no'),
+                             ('avg actors', 'avg_actors')]:
+            print("\t%s: mean: %f || std: %f" % (name, *results[metric]))
+
+
+if __name__ == '__main__':
+    main()
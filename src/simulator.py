@@ -2,90 +2,173 @@
 Simulation process.
 From micro-level decision making and learning, to macro-level simulation of Users on a graph network.
 """
+from functools import partial
 from typing import List
-from queue import PriorityQueue
 from event import CreateActorEvent, AccidentEvent
+from actor import ActorStore
+from event_calendar import HeapCalendar, ArrivalStream
 from graph import RoadGraph
-from utils import MultimodalDistribution
+from utils import MultimodalDistribution, replication_seed
 
+import pickle
 import random
+import zlib
+import numpy as np
 
 
 class Simulator:
     """Runs a simulation from a given set of parameters"""
 
+    # what makes up the state of a run, see get_state
+    STATE_FIELDS = ['replication', 'now', 'num_events', 'fused_events', 'event_queue', 'graph',
+                    'stats', 'actors', 'atis', 'actor_constructor']
+
     def __init__(self,
                  config,
                  actor_constructor,
                  atis_constructor,
                  stats_constructor,
                  traffic_distribution=MultimodalDistribution.default(),
+                 calendar_constructor=HeapCalendar,
+                 graph_constructor=RoadGraph,
+                 accidents=None,
                  seed=42):
+        """Accidents are given as (time, edge, capacity scale factor) tuples"""
 
         self.config = config
-        self.graph = RoadGraph()
+        self.graph_constructor = graph_constructor
+        self.graph = graph_constructor()
         self.num_actors = config.num_actors
         self.actor_constructor = actor_constructor
         self.atis_constructor = atis_constructor
         self.stats_constructor = stats_constructor
         self.traffic_distribution = traffic_distribution
+        self.calendar_constructor = calendar_constructor
         self.max_run_time = config.max_run_time
+        self.accidents = accidents if accidents is not None else []
         self.atis = None
         self.stats = None
         self.actors = None
-
+        self.event_queue = None
+        self.replication = None
+        # simulation time reached by the run
+        self.now = 0.0
+        # number of events processed by the last run, and how many of them were
+        # handled without going through the event queue (see can_fuse)
+        self.num_events = 0
+        self.fused_events = 0
+
+        self.seed = seed
         random.seed(seed)
 
-    def run(self):
-        # Empty actors list, in case of consecutive calls to this method
-        self.actors = []
+    def seed_replication(self, run: int):
+        """Seed the random generators with the stream of the given replication"""
+        run_seed = replication_seed(self.seed, run)
+        random.seed(run_seed)
+        np.random.seed(run_seed & 0xFFFFFFFF)
+
+    def run(self, replication: int = None, profiler=None):
+        """Run the simulation. If a replication number is given, its random stream is used,
+        making the run reproducible regardless of the runs that came before it.
+        If a profiler (see profiling.SimProfiler) is given, the run is instrumented by it"""
+        self.start(replication)
+        self.advance(profiler=profiler)
+        self.finish()
 
-        # Cleaning road graph
-        self.graph = RoadGraph()
+    def start(self, replication: int = None):
+        """Set up a new run, without simulating any event"""
+        self.replication = replication
+        if replication is not None:
+            self.seed_replication(replication)
+
+        # Empty actors store, in case of consecutive calls to this method
+        self.actors = ActorStore(keep_trails=self.config.verbose)
+
+        # Cleaning road graph, the routes between nodes are kept if the topology is the same
+        self.graph = self.graph_constructor(self.graph.route_index)
 
         # Create the Statistics module
         self.stats = self.stats_constructor(self.graph)
 
-        # Create the Simulation Actors
-        event_queue = PriorityQueue()
-        for ae in self.create_actors_events() + self.create_accident_events():
-            event_queue.put_nowait(ae.get_priorized())
-        # elements in form (time, event), to be ordered by first tuple member
+        # Create the Simulation Actors, as they arrive
+        self.event_queue = ArrivalStream(self.calendar_constructor(), self.create_arrival_times(),
+                                         partial(CreateActorEvent, actor_constructor=self.actor_constructor))
+        for ae in self.create_accident_events():
+            self.event_queue.push(ae)
 
         # Create the Universal Atis
         self.atis = self.atis_constructor(self.graph,
-                                          self.traffic_distribution,
-                                          event_queue)
-
-        # Start Simulation
-        while event_queue.qsize() > 0:
-            _, event = event_queue.get_nowait()
-            new_events = event.act(self)
-            for ev in new_events:
-                # If event doesn't exceed max_run_time
-                if ev.get_timestamp() < self.max_run_time:
-                    event_queue.put_nowait(ev.get_priorized())
-
+                                          self.traffic_distribution)
+
+        # Let the actor constructor draw all the actors at once, if it can
+        if hasattr(self.actor_constructor, 'prepare'):
+            self.actor_constructor.prepare(self.graph, self.num_actors)
+
+        self.now = 0.0
+        self.num_events = 0
+        self.fused_events = 0
+
+    def advance(self, until: float = None, profiler=None):
+        """Simulate the pending events scheduled before the given time, or all of them"""
+        until = until if until is not None else float('inf')
+        if profiler is not None:
+            profiler.simulate(self, self.event_queue, until)
+        else:
+            event_queue = self.event_queue
+            while len(event_queue) > 0 and event_queue.peek_time() < until:
+                event = event_queue.pop()
+                self.num_events += 1
+                new_events = event.act(self)
+                for ev in new_events:
+                    # If event doesn't exceed max_run_time
+                    if ev.get_timestamp() < self.max_run_time:
+                        event_queue.push(ev)
+
+        self.now = min(until, self.max_run_time)
+
+    def can_fuse(self, at_time: float) -> bool:
+        """Whether an event created by the current one, at the given time, would be dequeued
+        right after it, so that it can be handled at once instead of going through the queue"""
+        if at_time >= self.max_run_time:
+            return False
+        return len(self.event_queue) == 0 or self.event_queue.peek_time() > at_time
+
+    def finish(self):
+        """Close the run, once all its events are simulated"""
         # Set total_travel_time of all unfinished actors to max_run_time
-        for a in self.actors:
-            if not a.reached_dest():
-                a.total_travel_time = self.max_run_time
-
-    def get_time_from_traffic_distribution(self) -> float:
-        result = self.traffic_distribution()
-        while not 0.0 < result < 24.0:
-            result = self.traffic_distribution()
-        return result
-
-    def create_actors_events(self) -> List[CreateActorEvent]:
-        """Returns all scheduled CreateActorEvents"""
-        return [
-            CreateActorEvent(
-                self.get_time_from_traffic_distribution(), self.actor_constructor)
-            for _ in range(self.num_actors)
-        ]
+        self.actors.finish(self.max_run_time)
+        self.stats.finish(self.max_run_time)
+
+    def get_state(self) -> bytes:
+        """Compressed snapshot of the run state: pending events, graph, statistics,
+        actors, atis and random generators"""
+        state = {field: getattr(self, field) for field in self.STATE_FIELDS}
+        state['random_state'] = random.getstate()
+        state['np_random_state'] = np.random.get_state()
+        return zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+    def set_state(self, data: bytes):
+        """Continue from a snapshot taken by get_state, from a simulator with the same configuration"""
+        state = pickle.loads(zlib.decompress(data))
+        for field in self.STATE_FIELDS:
+            setattr(self, field, state[field])
+        random.setstate(state['random_state'])
+        np.random.set_state(state['np_random_state'])
+
+    def checkpoint(self, path: str):
+        """Save the run state to the given file"""
+        with open(path, 'wb') as fd:
+            fd.write(self.get_state())
+
+    def restore(self, path: str):
+        """Continue the run saved to the given file"""
+        with open(path, 'rb') as fd:
+            self.set_state(fd.read())
+
+    def create_arrival_times(self) -> np.ndarray:
+        """Returns the times of all the CreateActorEvents"""
+        return self.traffic_distribution.sample(self.num_actors)
 
     def create_accident_events(self) -> List[AccidentEvent]:
-        return [
-            # AccidentEvent(10.0, (3, 6), 0.2)
-        ]
+        # e.g. AccidentEvent(10.0, (3, 6), 0.2)
+        return [AccidentEvent(at_time, tuple(edge), factor) for at_time, edge, factor in self.accidents]
@@ -2,14 +2,147 @@
 Statistics from simulation run.
 Several metrics are updated as the simulation runs and then some analysis can be made.
 """
-from typing import List, Tuple, DefaultDict
+from typing import List, Tuple, DefaultDict, Dict, Union
 from matplotlib import pyplot as plt
 from collections import defaultdict
+from scipy.stats import t as student_t
+from utils import compute_average_over_time
+from data_plotting import plot_edges_occupancy
 
 import graph
 import numpy as np
 
-from actor import Actor
+from actor import ActorStore
+
+
+class RunningStats:
+    """Welford's online mean and variance (plus maximum) of a stream of values"""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.max = -np.inf
+
+    def add(self, value: float):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        if value > self.max:
+            self.max = value
+
+    def add_all(self, values: np.ndarray):
+        """Add a batch of values at once"""
+        batch = RunningStats()
+        batch.n = len(values)
+        if batch.n > 0:
+            batch.mean = np.mean(values)
+            batch.m2 = np.sum((values - batch.mean) ** 2)
+            batch.max = np.max(values)
+        self.merge(batch)
+
+    def merge(self, other):
+        """Combine another accumulator into this one (Chan et al. parallel formula)"""
+        n = self.n + other.n
+        if n == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta ** 2 * self.n * other.n / n
+        self.n = n
+        self.max = max(self.max, other.max)
+
+    def std(self) -> float:
+        """Population standard deviation, as np.std"""
+        return np.sqrt(self.m2 / self.n) if self.n > 0 else np.nan
+
+    @staticmethod
+    def merged(all_stats):
+        result = RunningStats()
+        for rs in all_stats:
+            result.merge(rs)
+        return result
+
+
+class RunSummary:
+    """
+    Compact summary of a single simulation run: everything needed to
+    merge several runs, without keeping the actors around.
+    Summaries of online statistics hold running accumulators instead
+    of the travel times, and no flow series.
+    """
+
+    actors_not_finishing: int
+    avg_actors: float
+    avg_edges: Dict[str, float]
+    # total travel times of the actors using (or not) atis
+    tt_atis: Union[np.ndarray, RunningStats]
+    tt_natis: Union[np.ndarray, RunningStats]
+    # flow series, as (time, atis delta, non atis delta) rows
+    actors_atis: np.ndarray
+    edges_flow_atis: Dict[Tuple[int, int], np.ndarray]
+    # online statistics only
+    max_actors: int
+    edges_tt: Dict[str, RunningStats]
+    # average and max atis and non atis users: [avg atis, avg non atis, max atis, max non atis],
+    # in the network and per edge
+    class_actors: List[float]
+    edges_class: Dict[str, List[float]]
+    # jit export of the graph at the end of the run, if requested
+    graph: str
+    # profiling.SimProfiler of the run, if profiled
+    profile: object
+
+    def __init__(self, actors_not_finishing, avg_actors, avg_edges, tt_atis, tt_natis,
+                 actors_atis=None, edges_flow_atis=None, max_actors=None, edges_tt=None,
+                 class_actors=None, edges_class=None):
+        self.actors_not_finishing = actors_not_finishing
+        self.avg_actors = avg_actors
+        self.avg_edges = avg_edges
+        self.tt_atis = tt_atis
+        self.tt_natis = tt_natis
+        self.actors_atis = actors_atis
+        self.edges_flow_atis = edges_flow_atis
+        self.max_actors = max_actors
+        self.edges_tt = edges_tt
+        self.class_actors = class_actors
+        self.edges_class = edges_class
+        self.graph = None
+        self.profile = None
+
+    def is_online(self) -> bool:
+        return isinstance(self.tt_atis, RunningStats)
+
+    def get_metric(self, name: str) -> float:
+        """Value of a metric in this run: time_atis_yes, time_atis_no (mean travel times, NaN without
+        actors) or avg_actors"""
+        if name == 'avg_actors':
+            return self.avg_actors
+        tt = {'time_atis_yes': self.tt_atis, 'time_atis_no': self.tt_natis}[name]
+        if isinstance(tt, RunningStats):
+            return tt.mean if tt.n > 0 else np.nan
+        return np.mean(tt) if len(tt) > 0 else np.nan
+
+
+def confidence_interval(values, confidence: float = 0.95) -> Tuple[float, float]:
+    """Mean and half width of the Student's t confidence interval of the mean of independent values,
+    NaN values aside. The half width is NaN with less than two values"""
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    n = len(values)
+    if n < 2:
+        return (values[0] if n == 1 else np.nan), np.nan
+    t = student_t.ppf((1 + confidence) / 2, n - 1)
+    return np.mean(values), t * np.std(values, ddof=1) / np.sqrt(n)
+
+
+def initial_flow() -> List[Tuple[float, int]]:
+    return [(0.0, 0)]
+
+
+def initial_flow_atis() -> List[Tuple[float, int, int]]:
+    return [(0.0, 0, 0)]
 
 
 class SimStats:
@@ -28,9 +161,9 @@ class SimStats:
         self.graph = g
         self.actors = []
         self.actors_in_graph = [(0.0, 0)]
-        self.edges_flow_over_time = defaultdict(lambda: [(0.0, 0)])
+        self.edges_flow_over_time = defaultdict(initial_flow)
         self.actors_atis = [(0.0, 0, 0)]
-        self.edges_flow_atis = defaultdict(lambda: [(0.0, 0, 0)])
+        self.edges_flow_atis = defaultdict(initial_flow_atis)
         pass
 
     def update_num_actors(self, ts: float, delta: int, has_atis: bool):
@@ -66,10 +199,36 @@ class SimStats:
         """Remove an actor from the given edge"""
         self.update_num_actors_edge(edge, ts, -1, has_atis)
 
-    def add_actors(self, actors: List[Actor]):
+    def add_actors(self, actors: ActorStore):
         """Store the actors present in the simulation"""
         self.actors = actors
 
+    def add_edge_travel_time(self, edge: Tuple[int, int], tt: float):
+        """Account for an actor that will take tt to traverse the given edge"""
+        pass
+
+    def add_trip_time(self, tt: float, has_atis: bool):
+        """Account for an actor that reached its destination after a trip of tt"""
+        pass
+
+    def finish(self, max_run_time: float):
+        """Close the statistics of a run, once all its events are simulated"""
+        pass
+
+    def get_summary(self) -> RunSummary:
+        """Summarize this run, after the actors were stored"""
+        tt = self.actors.get_column('total_travel_time')
+        uses_atis = self.actors.get_column('uses_atis').astype(bool)
+        return RunSummary(
+            actors_not_finishing=int(np.sum(~self.actors.reached_dest())),
+            avg_actors=compute_average_over_time(self.actors_in_graph),
+            avg_edges={str(e): compute_average_over_time(self.edges_flow_over_time[e])
+                       for e in self.edges_flow_over_time},
+            tt_atis=tt[uses_atis],
+            tt_natis=tt[~uses_atis],
+            actors_atis=np.array(self.actors_atis, dtype=float),
+            edges_flow_atis={e: np.array(flow, dtype=float) for e, flow in self.edges_flow_atis.items()})
+
     def plot(self):
         """Plotting system general usage"""
         data = np.array(self.actors_in_graph)
@@ -79,3 +238,116 @@ class SimStats:
         plt.ylabel("number of actors")
         plt.plot(x, y)
         plt.show()
+
+
+def integrate(acc: list, ts: float, delta: int):
+    """Bring a [last timestamp, count, area, max] accumulator up to ts (trapezoidal,
+    as compute_average_over_time), changing its count by delta"""
+    count = acc[1] + delta
+    acc[2] += (ts - acc[0]) * (acc[1] + count) / 2.0
+    acc[0] = ts
+    acc[1] = count
+    if count > acc[3]:
+        acc[3] = count
+
+
+class OnlineSimStats(SimStats):
+    """
+    Statistics accumulated as the events happen, in O(edges) memory:
+    time-weighted integrals and maxima of the actors in the network and in
+    each edge, as a whole and per class (atis and non atis users), and running
+    means/variances of the edges and trips travel times.
+    No flow series are kept, only the summary is plotted.
+    """
+
+    # accumulators indexes
+    LAST_TS = 0
+    COUNT = 1
+    AREA = 2
+    MAX = 3
+
+    def __init__(self, g: graph.RoadGraph, save_path="data"):
+        super().__init__(g, save_path)
+        self.actors_in_graph = None
+        self.actors_atis = None
+        self.last_ts = 0.0
+        self.num_actors = 0
+        self.max_actors = 0
+        self.actors_area = 0.0
+        # per class accumulators, atis users first, both brought up to every update as the flow series
+        self.actors_class_acc = ([0.0, 0, 0.0, 0], [0.0, 0, 0.0, 0])
+        # [last timestamp, count, area, max], in order of first use
+        self.edges_acc = {}
+        self.edges_class_acc = {}
+        self.edges_tt = {}
+        self.actors_not_finishing = 0
+        self.tt_atis = RunningStats()
+        self.tt_natis = RunningStats()
+
+    def update_num_actors(self, ts: float, delta: int, has_atis: bool):
+        num_actors = self.num_actors + delta
+        self.actors_area += (ts - self.last_ts) * (self.num_actors + num_actors) / 2.0
+        self.last_ts = ts
+        self.num_actors = num_actors
+        if num_actors > self.max_actors:
+            self.max_actors = num_actors
+        self.integrate_classes(self.actors_class_acc, ts, delta, has_atis)
+
+    def update_num_actors_edge(self, edge: Tuple[int, int], ts: float, delta: int, has_atis: bool):
+        acc = self.edges_acc.get(edge)
+        if acc is None:
+            acc = self.edges_acc[edge] = [0.0, 0, 0.0, 0]
+            self.edges_class_acc[edge] = ([0.0, 0, 0.0, 0], [0.0, 0, 0.0, 0])
+
+        integrate(acc, ts, delta)
+        self.integrate_classes(self.edges_class_acc[edge], ts, delta, has_atis)
+
+    @staticmethod
+    def integrate_classes(accs: Tuple[list, list], ts: float, delta: int, has_atis: bool):
+        integrate(accs[0], ts, delta if has_atis else 0)
+        integrate(accs[1], ts, 0 if has_atis else delta)
+
+    def get_class_summary(self, accs: Tuple[list, list]) -> List[float]:
+        """[avg atis, avg non atis, max atis, max non atis] of per class accumulators"""
+        atis, natis = accs
+        last_ts = atis[self.LAST_TS]
+        if last_ts <= 0:
+            return [0.0, 0.0, atis[self.MAX], natis[self.MAX]]
+        return [atis[self.AREA] / last_ts, natis[self.AREA] / last_ts, atis[self.MAX], natis[self.MAX]]
+
+    def add_edge_travel_time(self, edge: Tuple[int, int], tt: float):
+        rs = self.edges_tt.get(edge)
+        if rs is None:
+            rs = self.edges_tt[edge] = RunningStats()
+        rs.add(tt)
+
+    def add_trip_time(self, tt: float, has_atis: bool):
+        (self.tt_atis if has_atis else self.tt_natis).add(tt)
+
+    def finish(self, max_run_time: float):
+        """The actors still in the network travel for max_run_time, as set by ActorStore.finish"""
+        atis, natis = (acc[self.COUNT] for acc in self.actors_class_acc)
+        self.actors_not_finishing = atis + natis
+        self.tt_atis.add_all(np.full(atis, max_run_time))
+        self.tt_natis.add_all(np.full(natis, max_run_time))
+
+    def add_actors(self, actors: ActorStore):
+        """The actors travel times were accumulated as they finished, they are not stored"""
+        pass
+
+    def get_summary(self) -> RunSummary:
+        return RunSummary(
+            actors_not_finishing=self.actors_not_finishing,
+            avg_actors=self.actors_area / self.last_ts if self.last_ts > 0 else 0.0,
+            avg_edges={str(e): acc[self.AREA] / acc[self.LAST_TS] if acc[self.LAST_TS] > 0 else 0.0
+                       for e, acc in self.edges_acc.items()},
+            tt_atis=self.tt_atis,
+            tt_natis=self.tt_natis,
+            max_actors=self.max_actors,
+            edges_tt={str(e): rs for e, rs in self.edges_tt.items()},
+            class_actors=self.get_class_summary(self.actors_class_acc),
+            edges_class={str(e): self.get_class_summary(accs) for e, accs in self.edges_class_acc.items()})
+
+    def plot(self):
+        """Time-weighted average and max of the atis and non atis users of each edge"""
+        plot_edges_occupancy(self.get_summary().edges_class)
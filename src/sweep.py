@@ -0,0 +1,133 @@
+"""
+Parameter sweeps over simulation configurations.
+All (configuration, replication) pairs of a sweep are scheduled on a single
+pool of workers, and the results are kept in memory.
+
+Replication r of every configuration draws from the same random stream, derived
+from the seed, so configurations are compared under common random numbers: with
+the same arrivals, and with the ATIS users of a percentage among those of any
+higher one. Configurations with a target_ci are replicated in rounds until their
+confidence intervals are narrow enough (see main.py --target_ci); those that only
+differ in their ATIS percentage are run on the same replications, and judged by
+their differences to the first of them, run by run, which the common random
+numbers make much less variable than the metrics themselves.
+"""
+from typing import List
+from itertools import product
+from functools import partial
+from multiprocessing import Pool
+from tqdm import tqdm
+
+from main import default_config, run_replication, merge_summaries, replications_needed, metric_values, runs_needed
+from statistics import RunSummary, confidence_interval
+
+import argparse
+import pandas as pd
+
+METRICS = ['time_atis_yes', 'time_atis_no', 'avg_actors']
+
+# configurations only differing in this field share their replications when adaptive
+PAIRED_FIELD = 'atis_percentage'
+
+
+def config_grid(base: argparse.Namespace = None, **axes) -> List[argparse.Namespace]:
+    """Full-factorial grid of configurations: every combination of the given axes values
+    (e.g. num_actors=[200, 400], atis_percentage=[0.1, 0.2]) applied over the base configuration"""
+    base = base if base is not None else default_config()
+    keys = list(axes.keys())
+    configs = []
+    for values in product(*[axes[k] for k in keys]):
+        config = argparse.Namespace(**vars(base))
+        for key, value in zip(keys, values):
+            setattr(config, key, value)
+        configs.append(config)
+    return configs
+
+
+def _run_pair(configs: List[argparse.Namespace], pair):
+    config_idx, run = pair
+    return config_idx, run_replication(configs[config_idx], run, export_graph=False)
+
+
+def paired_groups(configs: List[argparse.Namespace]) -> List[List[int]]:
+    """Indexes of the configurations grouped by all their fields but PAIRED_FIELD"""
+    groups = {}
+    for i, config in enumerate(configs):
+        key = repr(sorted((k, v) for k, v in vars(config).items() if k != PAIRED_FIELD))
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+
+def paired_replications_needed(all_s: List[RunSummary], reference: List[RunSummary],
+                               target: float, confidence: float) -> int:
+    """replications_needed judged on the confidence intervals of the differences of the runs
+    to those of a reference configuration on the same replications, run by run"""
+    values = metric_values(all_s)
+    reference_values = metric_values(reference[:len(all_s)])
+    cis = {metric: confidence_interval(values[metric] - reference_values[metric], confidence)
+           for metric in values}
+    return runs_needed(values, cis, target)
+
+
+def next_runs(configs: List[argparse.Namespace], group: List[int], summaries: List[list]) -> int:
+    """Runs the configurations of a paired group should reach, from the ones they ran so far"""
+    config = configs[group[0]]
+    n = len(summaries[group[0]])
+    if getattr(config, 'target_ci', None) is None:
+        return config.n_runs
+    if n == 0:
+        return config.min_runs
+
+    reference = summaries[group[0]]
+    needed = max(replications_needed(summaries[i], config.target_ci, config.confidence) if i == group[0] else
+                 paired_replications_needed(summaries[i], reference, config.target_ci, config.confidence)
+                 for i in group)
+    # early estimates are noisy, the runs are at most doubled per round
+    return min(needed, 2 * n, config.max_runs)
+
+
+def run_sweep(configs: List[argparse.Namespace], workers: int = 1) -> pd.DataFrame:
+    """
+    Run every configuration of the sweep, spreading all their replications across a shared pool.
+    Configurations with a target_ci are run in rounds, until their confidence intervals are narrow enough.
+    Returns a DataFrame with one row per configuration: its fields, plus the
+    mean and standard deviation of each metric over the configuration runs.
+    """
+    task = partial(_run_pair, configs)
+    groups = paired_groups(configs)
+    summaries = [[] for _ in configs]
+    pool = Pool(workers) if workers > 1 else None
+
+    try:
+        while True:
+            pairs = []
+            for group in groups:
+                n_runs = next_runs(configs, group, summaries)
+                pairs += [(i, run) for i in group for run in range(len(summaries[i]), n_runs)]
+            if not pairs:
+                break
+
+            if pool is None:
+                results = [task(p) for p in tqdm(pairs, leave=False)]
+            else:
+                results = list(tqdm(pool.imap(task, pairs, chunksize=max(1, len(pairs) // (4 * workers))),
+                                    total=len(pairs), leave=False))
+
+            # pairs are listed, and thus returned, in replication order for each configuration
+            for config_idx, summary in results:
+                summaries[config_idx].append(summary)
+    finally:
+        if pool is not None:
+            pool.close()
+
+    rows = []
+    for config, config_summaries in zip(configs, summaries):
+        merged = merge_summaries(config_summaries)
+        row = dict(vars(config))
+        row['n_runs'] = len(config_summaries)
+        row['avg_actors_not_finishing'] = merged['avg_actors_not_finishing']
+        for metric in METRICS:
+            row[metric + '_mean'], row[metric + '_std'] = merged[metric]
+        rows.append(row)
+
+    return pd.DataFrame(rows)
@@ -26,8 +26,9 @@ class MultimodalDistribution:
 
         def pdf(self, x: float) -> float:
             """Get the value of the Probability Density Function (pdf) at the given x value"""
+            # np.square gives the same value for python floats, numpy scalars and arrays
             return 1/(np.sqrt(2 * np.pi * self.std**2)) *\
-                np.exp(- (x - self.mean)**2 / (2 * self.std**2))
+                np.exp(- np.square(x - self.mean) / (2 * self.std**2))
 
     def __init__(self, *dist_stats):
         self.stats = dist_stats
@@ -42,17 +43,78 @@ class MultimodalDistribution:
     def __call__(self):
         return random.choice(self.distributions)()
 
+    def sample(self, n: int, low: float = 0.0, high: float = 24.0) -> np.ndarray:
+        """Draw n values at once, truncated to the open interval (low, high).
+        Values out of it are rejected and drawn again, in batches"""
+        means = np.array([d.mean for d in self.distributions], dtype=float)
+        stds = np.array([d.std for d in self.distributions], dtype=float)
+
+        samples = np.empty(n, dtype=float)
+        filled = 0
+        while filled < n:
+            missing = n - filled
+            peaks = np.random.randint(len(self.distributions), size=missing)
+            values = np.random.normal(means[peaks], stds[peaks])
+            values = values[(low < values) & (values < high)]
+            samples[filled:filled + len(values)] = values
+            filled += len(values)
+        return samples
+
     @staticmethod
     def default():
         return MultimodalDistribution([8, 3], [18, 3])
 
 
+class DemandTable:
+    """
+    Expected traffic demand, the traffic distribution pdf scaled by the number of actors,
+    over the simulation horizon. With a positive resolution (in hours) the pdf is tabulated
+    once, at the start of every bucket (see at_bucket). Exact values are remembered for recent
+    timestamps, as routes are costed from the same timestamp many times.
+    """
+
+    # number of exact values remembered before they are forgotten
+    MEMO_SIZE = 4096
+
+    def __init__(self, td: MultimodalDistribution, num_actors: int, horizon: float, resolution: float = 0.0):
+        self.td = td
+        self.num_actors = num_actors
+        self.resolution = resolution
+        self.memo = {}
+        if resolution > 0:
+            grid = np.arange(0.0, horizon + 2 * resolution, resolution)
+            self.values = (td.pdf(grid) * num_actors).tolist()
+        else:
+            self.values = []
+
+    def exact(self, t: float) -> float:
+        """Demand at the given time"""
+        value = self.memo.get(t)
+        if value is None:
+            if len(self.memo) >= self.MEMO_SIZE:
+                self.memo.clear()
+            value = self.memo[t] = self.td.pdf(t) * self.num_actors
+        return value
+
+    def at_bucket(self, bucket: int) -> float:
+        """Demand at the start of the given bucket (of resolution hours)"""
+        if 0 <= bucket < len(self.values):
+            return self.values[bucket]
+        return self.exact(bucket * self.resolution)
+
+
 def congestion_time_estimate(free_flow: float, capacity: float, volume: float) -> float:
     """US Bureau ofPublic Roads (BPR) congestion function.
     Used to compute the traverse time of an edge"""
     return free_flow * (1 + 0.15 * math.pow((volume/capacity), 4))
 
 
+def congestion_time_estimates(free_flow: np.ndarray, capacity: np.ndarray, volume: np.ndarray) -> np.ndarray:
+    """Batched version of the BPR congestion function, for several edges at once.
+    np.float_power goes through the same pow as math.pow, so the results are the same as congestion_time_estimate"""
+    return free_flow * (1 + 0.15 * np.float_power(volume / capacity, 4.0))
+
+
 def softmax_travel_times(travel_times):
     """Apply the softmax function to the given array of values"""
     # invert number so that smaller travel times have higher probability
@@ -62,6 +124,16 @@ def softmax_travel_times(travel_times):
     return e_tt / e_tt.sum(axis=0)
 
 
+def replication_seed(seed: int, run: int) -> int:
+    """Derive the seed of a given replication from the simulation seed (SplitMix64 mixing),
+    so that each replication has its own reproducible random stream"""
+    mask = 0xFFFFFFFFFFFFFFFF
+    z = (seed + (run + 1) * 0x9E3779B97F4A7C15) & mask
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask
+    return z ^ (z >> 31)
+
+
 def compute_average_over_time(dist: List[Tuple[float, int]]):
     dist = np.array(dist)
     return trapz(dist[:, 1], dist[:, 0]) / dist[-1][0]